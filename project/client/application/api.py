@@ -1,7 +1,11 @@
 """API for the SteeleLab Vector Network Analyser"""
 
 import ipaddress as ip
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import fields
+from datetime import datetime
+from time import perf_counter_ns, time_ns
 
 import numpy as np
 import xarray as xr
@@ -72,27 +76,30 @@ class SLVNA(SLVNAConfig):
         if self.gen_clk is None:
             raise NotImplementedError("fsweep() not implemented without clock generator!")
 
-        with self.gen_rf, self.gen_lo, self.gen_clk:  # Connect to generators
-            printd(f"Connected with {self.gen_rf.name} as RF generator.")
-            printd(f"Connected with {self.gen_lo.name} as LO generator.")
-            printd(f"Connected with {self.gen_clk.name} as clock generator.")
-            with TCPClient(host=str(self.addr_soc[0]), port=self.addr_soc[1]) as tcp:  # Connect to SoC
+        with ExitStack() as stack:
+            # Connect to generators and SoC at the same time, they are disconnected in reverse order
+            tcp = self._connect_concurrently(stack, self.gen_rf, self.gen_lo, self.gen_clk)
+            if SLVNA.DEBUG:
+                printd(f"Connected with {self.gen_rf.name} as RF generator.")
+                printd(f"Connected with {self.gen_lo.name} as LO generator.")
+                printd(f"Connected with {self.gen_clk.name} as clock generator.")
                 printd(f"Connected with {self.addr_soc[0]}:{self.addr_soc[1]} as SoC.")
 
-                # RF signal through DuT
-                self.gen_rf.fsweep(self.start_freq, self.stop_freq, self.power, self.points, self.timestep)
-                # LO signal to the mixers
-                self.gen_lo.fsweep(
-                    self.start_freq + self.ifreq, self.stop_freq + self.ifreq, self.lo_power, self.points, self.timestep
-                )
-                # Clock signal to the SoC (turns on immediately to process configuration)
-                if self.gen_clk is not None:
-                    self.gen_clk.continuous_wave(self.socclk_freq, self.socclk_power)
-                    self.gen_clk.rf_on()
-
-                printd("Configured generators!")
-
-                # Configure SoC
+            # RF signal through DuT
+            self.gen_rf.fsweep(self.start_freq, self.stop_freq, self.power, self.points, self.timestep)
+            # LO signal to the mixers
+            self.gen_lo.fsweep(
+                self.start_freq + self.ifreq, self.stop_freq + self.ifreq, self.lo_power, self.points, self.timestep
+            )
+            # Clock signal to the SoC (turns on immediately to process configuration)
+            if self.gen_clk is not None:
+                self.gen_clk.continuous_wave(self.socclk_freq, self.socclk_power)
+                self.gen_clk.rf_on()
+
+            if SLVNA.DEBUG: printd("Configured generators!")
+
+            # Configure SoC, all settings are sent in one go
+            with tcp.batch():
                 tcp.send_tpp(self.timestep)
                 tcp.send_dead_time(self._deadtime)
                 tcp.send_trigger_length(self._triglen)
@@ -109,62 +116,54 @@ class SLVNA(SLVNAConfig):
                     step=self._lo_cap["trigger"]["remaining"]
                 )
 
-                # Prepare empty data buffer
-                data = np.empty((self.points, 4))
-
-                # Log before acquisition
-                start_temperature = tcp.get_server_cpu_temp()
-                start_time = datetime.now()
-                printd(f"Starting acquisition at {start_time}, ETA {start_time + timedelta(seconds=self.timestep*self.points)} "\
-                      f"({self.timestep*self.points:.2f}s). SoC temperature {start_temperature}C.")
-
-                # Enable output of the generators and start acquisition
-                self.gen_rf.rf_on()
-                self.gen_lo.rf_on()
-                tcp.start_acquisition()
-
-                # Request data via TCP and put it in the data buffer until we have received all points
-                points_done = 0
-                while points_done < self.points:
-                    # Receive new data and check how many points we got
-                    # (don't need to round because tcp.request_data() returns whole number of points)
-                    voltages = np.array(tcp.request_data())
-                    points_received = len(voltages) // 4
-
-                    # Discard unnecessary data from last packet
-                    points_todo = self.points - points_done
-                    if points_received > points_todo:
-                        voltages = voltages[:4 * points_todo]
-                        points_received = points_todo
-
-                    # Save data and update points_done
-                    data[points_done:points_done + points_received] = voltages.reshape(points_received, 4)
-                    points_done += points_received
-
-                # Loop is done, stop acquisition and turn generators off again
-                tcp.stop_acquisition()
-                self.gen_rf.rf_off()
-                self.gen_lo.rf_off()
-
-                # Log end of acquisition
-                stop_time = datetime.now()
-                stop_temperature = tcp.get_server_cpu_temp()
-                printd(f"Done acquiring at {stop_time}, took {stop_time-start_time} total. "\
+            # Prepare data buffer
+            data = self._receive_buffer(self.points)
+
+            # Log before acquisition
+            start_temperature = tcp.get_server_cpu_temp()
+            start_ns, start_mono_ns = time_ns(), perf_counter_ns()  # Wall clock for metadata, monotonic for duration
+            if SLVNA.DEBUG:
+                eta_s = self.timestep * self.points  # [s] Expected duration of the acquisition
+                printd(f"Starting acquisition, ETA {datetime.fromtimestamp(start_ns / 1E9 + eta_s)} ({eta_s:.2f}s). "\
+                      f"SoC temperature {start_temperature}C.")
+
+            # Enable output of the generators and start acquisition
+            self.gen_rf.rf_on()
+            self.gen_lo.rf_on()
+            tcp.start_acquisition()
+
+            # Request all points via TCP, directly into the data buffer
+            tcp.request_data_bulk(self.points, out=data)
+
+            # Stop acquisition and turn generators off again
+            tcp.stop_acquisition()
+            self.gen_rf.rf_off()
+            self.gen_lo.rf_off()
+
+            # Log end of acquisition
+            stop_ns, stop_mono_ns = time_ns(), perf_counter_ns()
+            stop_temperature = tcp.get_server_cpu_temp()
+            if SLVNA.DEBUG:
+                printd(f"Done acquiring, took {(stop_mono_ns - start_mono_ns) / 1E9:.3f}s total. "\
                       f"SoC temperature {stop_temperature}C.")
 
-                # Turn off SoC clock last
-                if self.gen_clk is not None:
-                    self.gen_clk.rf_off()
-
-        # Calculate derived values
-        t = np.arange(self.points, dtype=np.float64) * self.timestep
-        f = np.linspace(self.start_freq, self.stop_freq, self.points)
+            # Turn off SoC clock last
+            if self.gen_clk is not None:
+                self.gen_clk.rf_off()
+
+        # Calculate derived values, f and t are affine transforms of the point index (f equals np.linspace)
+        start_freq, stop_freq, points = self.start_freq, self.stop_freq, self.points
+        t = np.arange(points, dtype=np.float64)
+        f = t * ((stop_freq - start_freq) / max(points - 1, 1))
+        f += start_freq
+        f[-1] = stop_freq if points > 1 else start_freq
+        t *= self.timestep
         output = self._expand_data(t, f, data)
 
         # Construct metadata dataset
         meta = self.get_config_data()
-        meta["start_time"] = str(start_time)
-        meta["stop_time"] = str(stop_time)
+        meta["start_time"] = str(datetime.fromtimestamp(start_ns / 1E9))
+        meta["stop_time"] = str(datetime.fromtimestamp(stop_ns / 1E9))
         meta["start_temperature"] = start_temperature
         meta["stop_temperature"] = stop_temperature
 
@@ -215,75 +214,161 @@ class SLVNA(SLVNAConfig):
         pass
 
     def __repr__(self) -> str:
-        return f"SLVNA({self.__dict__})"
+        return f"SLVNA({ {f.name: getattr(self, f.name) for f in fields(self) if f.repr} })"
 
     def __str__(self) -> str:
         return f"SteeleLab VNA object, sweep mode {self.sweep_mode}"
 
     # -- INTERNAL --
+    def _connect_concurrently(self, stack: ExitStack, *gens: BaseSCPIGeneratorController) -> TCPClient:
+        """Connects to the given generators and the SoC at the same time and registers their disconnects on `stack`.
+        Returns the TCP client connected to the SoC. Raises the first error after registering all successful connections."""
+        with ThreadPoolExecutor(max_workers=len(gens) + 1) as pool:
+            gen_futures = [pool.submit(gen.__enter__) for gen in gens]
+            tcp_future = pool.submit(TCPClient, host=str(self.addr_soc[0]), port=self.addr_soc[1])
+
+        error = None
+        for gen, future in zip(gens, gen_futures):
+            if future.exception() is None:
+                stack.push(gen)  # Registers gen.__exit__
+            elif error is None:
+                error = future.exception()
+        tcp = tcp_future.result() if tcp_future.exception() is None else None
+        if error is None and tcp is None:
+            error = tcp_future.exception()
+        if error is not None:
+            if tcp is not None:
+                tcp.__exit__(type(error), error, error.__traceback__)  # Connected, but will not be used
+            raise error
+        stack.push(tcp)  # Registers tcp.__exit__
+        return tcp
+
+    def _receive_buffer(self, points: int) -> np.ndarray:
+        """Returns an empty buffer for receiving `points` points, reusing the buffer of previous sweeps if large enough.
+        Safe because _expand_data() copies the data, so results never refer to this buffer."""
+        if self._rx_buffer is None or self._rx_buffer.shape[0] < points:
+            self._rx_buffer = np.empty((points, 4), dtype=np.float64)  # Server sends 64-bit floats
+        return self._rx_buffer[:points]
+
     @staticmethod
-    def _unwrap_phase(phase_array: np.ndarray, first_freq: float, last_freq: float) -> np.ndarray:
-        """Unwraps the phase array in radians and adds the average slope to it."""
-        ph_unwrapped = np.unwrap(phase_array)
+    def _unwrap_phase(
+        phase_array: np.ndarray, first_freq: float, last_freq: float, out: np.ndarray | None = None
+    ) -> np.ndarray:
+        """Unwraps the phase array in radians and adds the average slope to it.
+        Writes the result into `out` if given (may not be `phase_array` itself)."""
+        ph_unwrapped = np.empty_like(phase_array) if out is None else out
+        # Same result as np.unwrap(), but without temporaries: add the cumulative sum of the
+        # multiples of 2 pi that make every step between neighbouring points smaller than pi
+        steps = ph_unwrapped[1:]
+        np.subtract(phase_array[1:], phase_array[:-1], out=steps)
+        steps /= -2 * np.pi
+        np.round(steps, out=steps)
+        np.cumsum(steps, out=steps)
+        steps *= 2 * np.pi
+        ph_unwrapped[0] = 0
+        ph_unwrapped += phase_array
+
         first_ph, last_ph = ph_unwrapped[[0, -1]]
         avg_slope = (last_ph - first_ph) / (last_freq - first_freq)
-        return ph_unwrapped - np.linspace(0, last_freq - first_freq, num=ph_unwrapped.shape[0]) * avg_slope
+        # Frequencies are evenly spaced, so the slope is subtracted per point index in place
+        freq_step = (last_freq - first_freq) / (ph_unwrapped.shape[0] - 1)
+        ph_unwrapped -= np.arange(ph_unwrapped.shape[0]) * (avg_slope * freq_step)
+        return ph_unwrapped
 
     @staticmethod
     def _expand_data(t: np.ndarray, f: np.ndarray, data: np.ndarray) -> xr.Dataset:
-        # Caculate phasors for DUT, REF and S21
-        p_dut = (data[:, 0] + 1j * data[:, 1]).astype(np.complex128)
-        p_ref = (data[:, 2] + 1j * data[:, 3]).astype(np.complex128)
-        S_21 = (p_dut / p_ref) ** 2  # S_21 is a power and p (phasors) are voltages, so square the ratio.
+        # Single float64 buffer holding every real-valued column as a contiguous row (structure of arrays)
+        buf = np.empty((16, data.shape[0]), dtype=np.float64)
+        (
+            DUT_re_V, DUT_im_V, REF_re_V, REF_im_V, DUT_mag_V, DUT_mag_dBm, DUT_phase, REF_mag_V, REF_mag_dBm, REF_phase,
+            S_21_re, S_21_im, S_21_mag, S_21_mag_dB, S_21_phase, S_21_phase_unwrapped
+        ) = buf
+        buf[:4] = data.T  # I_dut, Q_dut, I_ref, Q_ref
+        scratch = np.empty(data.shape[0], dtype=np.float64)
+
+        # Caculate phasors for DUT and REF, only needed for the complex columns of the dataset
+        p_dut = np.empty(data.shape[0], dtype=np.complex128)
+        p_dut.real, p_dut.imag = DUT_re_V, DUT_im_V
+        p_ref = np.empty(data.shape[0], dtype=np.complex128)
+        p_ref.real, p_ref.imag = REF_re_V, REF_im_V
+
+        # Derive values for DUT, the squared magnitude is kept in DUT_mag_V until S_21_mag and the log are done
+        np.multiply(DUT_re_V, DUT_re_V, out=DUT_mag_V)
+        DUT_mag_V += np.multiply(DUT_im_V, DUT_im_V, out=scratch)
+        np.log10(DUT_mag_V, out=DUT_mag_dBm)
+        DUT_mag_dBm *= 10
+        DUT_mag_dBm += 10
+        np.arctan2(DUT_im_V, DUT_re_V, out=DUT_phase)
+
+        # Derive values for REF, the same way
+        np.multiply(REF_re_V, REF_re_V, out=REF_mag_V)
+        REF_mag_V += np.multiply(REF_im_V, REF_im_V, out=scratch)
+        np.log10(REF_mag_V, out=REF_mag_dBm)
+        REF_mag_dBm *= 10
+        REF_mag_dBm += 10
+        np.arctan2(REF_im_V, REF_re_V, out=REF_phase)
+
+        # S_21 is a power and p (phasors) are voltages, so square the ratio: S_21 = (p_dut / p_ref)^2
+        # Ratio in rectangular form, p_dut / p_ref = p_dut * conj(p_ref) / |p_ref|^2 (REF_mag_V still holds |p_ref|^2)
+        np.multiply(DUT_re_V, REF_re_V, out=S_21_re)
+        S_21_re += np.multiply(DUT_im_V, REF_im_V, out=scratch)
+        S_21_re /= REF_mag_V
+        np.multiply(DUT_im_V, REF_re_V, out=S_21_im)
+        S_21_im -= np.multiply(DUT_re_V, REF_im_V, out=scratch)
+        S_21_im /= REF_mag_V
+        # Square in place, (x + iy)^2 = x^2 - y^2 + 2ixy
+        np.multiply(S_21_re, S_21_im, out=scratch)
+        S_21_re *= S_21_re
+        S_21_im *= S_21_im
+        S_21_re -= S_21_im
+        np.multiply(scratch, 2, out=S_21_im)
+        S_21 = np.empty(data.shape[0], dtype=np.complex128)
+        S_21.real, S_21.imag = S_21_re, S_21_im
         # TODO is phase correct? amount of peaks?
 
-        # Derive values for DUT
-        DUT_re_V = np.real(p_dut).astype(np.float64)  # Also I_dut
-        DUT_im_V = np.imag(p_dut).astype(np.float64)  # Also Q_dut
-        DUT_mag_V = np.abs(p_dut).astype(np.float64)
-        DUT_mag_dBm = (20 * np.log10(DUT_mag_V) + 10).astype(np.float64)
-        DUT_phase = np.angle(p_dut).astype(np.float64)
-
-        # Derive values for REF
-        REF_re_V = np.real(p_ref).astype(np.float64)  # Also I_ref
-        REF_im_V = np.imag(p_ref).astype(np.float64)  # Also Q_ref
-        REF_mag_V = np.abs(p_ref).astype(np.float64)
-        REF_mag_dBm = (20 * np.log10(REF_mag_V) + 10).astype(np.float64)
-        REF_phase = np.angle(p_ref).astype(np.float64)
-
-        # Derive values for S21
-        S_21_re = np.real(S_21).astype(np.float64)
-        S_21_im = np.imag(S_21).astype(np.float64)
-        S_21_mag = np.abs(S_21).astype(np.float64)
-        S_21_mag_dB = 10 * np.log10(S_21_mag).astype(np.float64)
-        S_21_phase = np.angle(S_21).astype(np.float64)
-        S_21_phase_unwrapped = SLVNA._unwrap_phase(S_21_phase, *f[[0, -1]])
+        # Derive other values for S21, |S21| = (|p_dut| / |p_ref|)^2 and arg(S21) = 2 * (arg(p_dut) - arg(p_ref))
+        np.divide(DUT_mag_V, REF_mag_V, out=S_21_mag)
+        np.subtract(DUT_mag_dBm, REF_mag_dBm, out=S_21_mag_dB)  # 10 * log10(S_21_mag), offsets cancel
+        np.subtract(DUT_phase, REF_phase, out=S_21_phase)
+        S_21_phase *= 2
+        S_21_phase += np.pi
+        np.mod(S_21_phase, 2 * np.pi, out=S_21_phase)
+        S_21_phase -= np.pi
+        SLVNA._unwrap_phase(S_21_phase, *f[[0, -1]], out=S_21_phase_unwrapped)
+
+        # Squared magnitudes are no longer needed
+        np.sqrt(DUT_mag_V, out=DUT_mag_V)
+        np.sqrt(REF_mag_V, out=REF_mag_V)
 
         # Other values
         # TODO: spectrum, group delay
         # Spectrum may need overlay change? (sync deadtime to IF to keep phase) (or not because internal IF is continuous??)
 
-        # Combine into dataset
-        return xr.Dataset({
-            "f": f,
-            "t": t,  # t maps 1:1 to f but I don't know how to do that in xarray :/
-            "P_dut": ("f", p_dut),
-            "P_ref": ("f", p_ref),
-            "S_21": ("f", S_21),
-            "DUT_re_V": ("f", DUT_re_V),
-            "DUT_im_V": ("f", DUT_im_V),
-            "DUT_mag_V": ("f", DUT_mag_V),
-            "DUT_mag_dBm": ("f", DUT_mag_dBm),
-            "DUT_phase": ("f", DUT_phase),
-            "REF_re_V": ("f", REF_re_V),
-            "REF_im_V": ("f", REF_im_V),
-            "REF_mag_V": ("f", REF_mag_V),
-            "REF_mag_dBm": ("f", REF_mag_dBm),
-            "REF_phase": ("f", REF_phase),
-            "S_21_re": ("f", S_21_re),
-            "S_21_im": ("f", S_21_im),
-            "S_21_mag": ("f", S_21_mag),
-            "S_21_mag_dB": ("f", S_21_mag_dB),
-            "S_21_phase": ("f", S_21_phase),
-            "S_21_phase_unwrapped": ("f", S_21_phase_unwrapped),
-        })
+        # Combine into dataset, wrapping the arrays in variables directly as they need no coercion by xarray
+        columns = {
+            "P_dut": p_dut,
+            "P_ref": p_ref,
+            "S_21": S_21,
+            "DUT_re_V": DUT_re_V,
+            "DUT_im_V": DUT_im_V,
+            "DUT_mag_V": DUT_mag_V,
+            "DUT_mag_dBm": DUT_mag_dBm,
+            "DUT_phase": DUT_phase,
+            "REF_re_V": REF_re_V,
+            "REF_im_V": REF_im_V,
+            "REF_mag_V": REF_mag_V,
+            "REF_mag_dBm": REF_mag_dBm,
+            "REF_phase": REF_phase,
+            "S_21_re": S_21_re,
+            "S_21_im": S_21_im,
+            "S_21_mag": S_21_mag,
+            "S_21_mag_dB": S_21_mag_dB,
+            "S_21_phase": S_21_phase,
+            "S_21_phase_unwrapped": S_21_phase_unwrapped,
+        }
+        data_vars = {
+            "f": xr.Variable(("f", ), f, fastpath=True),
+            "t": xr.Variable(("t", ), t, fastpath=True),  # t maps 1:1 to f but I don't know how to do that in xarray :/
+        }
+        data_vars.update((name, xr.Variable(("f", ), column, fastpath=True)) for name, column in columns.items())
+        return xr.Dataset(data_vars)
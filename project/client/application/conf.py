@@ -2,12 +2,15 @@
 
 import ipaddress as ip
 import threading as td
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from logging import warning
 from math import ceil
+from time import monotonic
 from typing import ClassVar
 
+import numpy as np
 import xarray as xr
 
 from project.client.generator.base_controller import BaseSCPIGeneratorController
@@ -39,6 +42,11 @@ class SLVNAConfig:
     _lo_cap: dict = None  # [-] Capabilities dict of the LO generator. Set by SLVNA._ready_check()
     _deadtime: float = None  # [s] Deadtime at the beginning of each point. Set by SLVNA._ready_check()
     _triglen: float = None  # [s] Trigger pulse length. Set by SLVNA._ready_check()
+    # Runtime caches, left out of comparisons and representations.
+    # [-] Generator id to (generator, time, rtt) of its last ping. Set by SLVNA._ready_check()
+    _ping_cache: dict = field(default=None, init=False, compare=False, repr=False)
+    # [-] Buffer for receiving data, reused between sweeps. Set by SLVNA._fsweep()
+    _rx_buffer: np.ndarray = field(default=None, init=False, compare=False, repr=False)
 
     # Advanced settings, should really just be left alone
     sweep_mode: str | None = None  # [-] Selected sweep mode, of
@@ -50,7 +58,21 @@ class SLVNAConfig:
 
     _running: td.Event = td.Event()  # [-] VNA currently measuring. Do not modify any properties when set!
 
+    DEBUG: ClassVar[bool] = True  # [-] Whether to print debugging information during a sweep
     HIGH_PING: ClassVar[float] = 20E-3  # [s] When ping to generator rtt is above this threshold, warning/raise exception.
+    PING_TTL: ClassVar[float] = 30.  # [s] How long a generator ping rtt is reused by readiness checks before pinging again.
+    SWEEP_OPERATIONS: ClassVar[dict] = {  # [-] Generator operation needed by the RF and LO generators per sweep mode
+        "frequency": BaseSCPIGeneratorController.fsweep,
+        "power": BaseSCPIGeneratorController.psweep
+    }
+    CONFIG_FORMATTERS: ClassVar[dict] = {  # [-] Conversion of fields in `get_config_data` that cannot be stored as-is
+        "addr_soc": lambda addr: f"{addr[0]}:{addr[1]}",
+        "gen_rf": repr,
+        "gen_lo": repr,
+        "gen_clk": repr
+    }
+    CONFIG_SKIP: ClassVar[frozenset] = frozenset(  # [-] Temporaries left out by `get_config_data`
+        {"_rf_cap", "_lo_cap", "_running", "_ping_cache", "_rx_buffer"})
 
     # -- CONFIGURATION METHODS --
     def set_(self, **kwargs) -> None:
@@ -215,93 +237,94 @@ class SLVNAConfig:
         # Create empty set
         config = xr.Dataset()
 
-        # Copy over the configuration
-        d = self.__dict__
-        for key in d:
-            if key in {'addr_soc'}:
-                # Format address of SoC as string
-                config[key] = f"{d[key][0]}:{d[key][1]}"
-            elif key in {'gen_rf', 'gen_lo', 'gen_clk'}:
-                # Look up names of generators
-                config[key] = repr(d[key])
-            elif key in {"_rf_cap", "_lo_cap", "_running"}:
-                # Discard some temporaries
+        # Copy over the configuration, formatting addresses and generators and discarding some temporaries
+        formatters, skip = SLVNAConfig.CONFIG_FORMATTERS, SLVNAConfig.CONFIG_SKIP
+        for key, value in self.__dict__.items():
+            if key in skip:
                 continue
-            else:
-                # Just copy all other parameters
-                config[key] = d[key]
+            formatter = formatters.get(key)
+            config[key] = value if formatter is None else formatter(value)
 
         config["time"] = str(datetime.now())
 
         return config
 
     # -- INTERNAL --
-    def _ready_checks(self, fail_on_warning: bool = False) -> None:
+    def _ready_checks(self, fail_on_warning: bool = False, force_ping: bool = False) -> None:
         """Performs various readiness checks. Returns None if succesfull, raises the appropriate exceptions if not.
-        Can also raise several warningings or turn these into exceptions."""
+        Can also raise several warningings or turn these into exceptions.
+        Generator pings are reused for `PING_TTL` seconds, unless `force_ping` is True."""
 
         # Verify no measurement is running at this moment (if threaded).
         if self.running:
             raise ValueError("VNA not ready; currently performing a measurement!")
 
-        # Make set of required properties for this mode
-        to_check = {self.addr_soc, self.gen_rf, self.gen_lo, self.timestep}
-        if self.sweep_mode == "frequency":
-            to_check.update({self.start_freq, self.stop_freq, self.points, self.power})
-        elif self.sweep_mode == "continuouswave":
-            to_check.update({self.freq, self.points, self.power})
-        elif self.sweep_mode == "time":
-            to_check.update({self.freq, self.points})
-        elif self.sweep_mode == "power":
-            to_check.update({self.start_power, self.stop_power, self.points, self.freq})
-        elif self.sweep_mode == "2d":
-            to_check.update({
-                self.start_freq, self.stop_freq, self.points, self.start_power, self.stop_power, self.power_points
-            })
+        gen_rf, gen_lo, gen_clk, sweep_mode = self.gen_rf, self.gen_lo, self.gen_clk, self.sweep_mode
+
+        # Make list of required properties for this mode (a list, as generators need not be hashable)
+        to_check = [self.addr_soc, gen_rf, gen_lo, self.timestep]
+        if sweep_mode == "frequency":
+            to_check += [self.start_freq, self.stop_freq, self.points, self.power]
+        elif sweep_mode == "continuouswave":
+            to_check += [self.freq, self.points, self.power]
+        elif sweep_mode == "time":
+            to_check += [self.freq, self.points]
+        elif sweep_mode == "power":
+            to_check += [self.start_power, self.stop_power, self.points, self.freq]
+        elif sweep_mode == "2d":
+            to_check += [self.start_freq, self.stop_freq, self.points, self.start_power, self.stop_power, self.power_points]
         else:
-            raise NotImplementedError(f"Mode {self.sweep_mode} not implemented!")
+            raise NotImplementedError(f"Mode {sweep_mode} not implemented!")
 
         # Check if every required property is specified
         for v in to_check:
             if v is None:
-                raise ValueError(f"Not all parameters needed for mode {self.sweep_mode} specified!")
+                raise ValueError(f"Not all parameters needed for mode {sweep_mode} specified!")
 
         # warning if no SoC clock generator is specified
-        if self.gen_clk is None:
+        if gen_clk is None:
             if fail_on_warning: raise ValueError("Red Pitaya clock generator not specified!")
             else: warning("Red Pitaya clock generator not specified, assuming it has an external clock source!")
 
         # Check connection to generators as PyVISA doesn't like high ping.
-        for gen in (self.gen_rf, self.gen_lo, self.gen_clk):
-            if gen is not None:
-                rtt = gen.network_ping_rtt()[1]
-                if rtt < SLVNAConfig.HIGH_PING:
-                    continue
-                if fail_on_warning:
-                    raise ValueError(
-                        f"High ping round trip time ({rtt} s) to {gen}; "
-                        "unable to reliably control via PyVISA!"
-                    )
-                else:
-                    warning(f"High ping round trip time ({rtt} s) to {gen}; control could be unreliable!")
-
-        # Check if generators can do the required sweep.
-        match self.sweep_mode:
-            case "frequency" | "power":
-                key = BaseSCPIGeneratorController.fsweep if "frequency" else BaseSCPIGeneratorController.psweep
-                if not self.gen_rf.capabilities()["operations"][key]:
-                    raise NotImplementedError(f"RF generator {self.gen_rf} cannot perform fsweep!")
-                if not self.gen_lo.capabilities()["operations"][key]:
-                    raise NotImplementedError(f"LO generator {self.gen_lo} cannot perform fsweep!")
-            case _:
-                warning(f"Ready checks for sweep mode '{self.sweep_mode}' are not implemented.")
-        if self.gen_clk is not None and not self.gen_clk.capabilities()["operations"][
-            BaseSCPIGeneratorController.continuous_wave]:
-            raise NotImplementedError(f"Clock generator {self.gen_clk} cannot do continuous wave!")
+        gens = [g for g in (gen_rf, gen_lo, gen_clk) if g is not None]
+        if self._ping_cache is None or force_ping:
+            self._ping_cache = {}
+        now = monotonic()
+        to_ping = []
+        for gen in gens:
+            cached = self._ping_cache.get(id(gen))
+            if cached is None or cached[0] is not gen or now - cached[1] > SLVNAConfig.PING_TTL:
+                to_ping.append(gen)
+        if to_ping:
+            with ThreadPoolExecutor(max_workers=len(to_ping)) as pool:  # ping all generators at the same time
+                for gen, rtt in zip(to_ping, pool.map(lambda g: g.network_ping_rtt()[1], to_ping)):
+                    self._ping_cache[id(gen)] = (gen, now, rtt)
+        for gen in gens:
+            rtt = self._ping_cache[id(gen)][2]
+            if rtt is None or rtt < SLVNAConfig.HIGH_PING:  # None if the generator cannot be pinged
+                continue
+            if fail_on_warning:
+                raise ValueError(f"High ping round trip time ({rtt} s) to {gen}; "
+                    "unable to reliably control via PyVISA!")
+            else:
+                warning(f"High ping round trip time ({rtt} s) to {gen}; control could be unreliable!")
 
         # Get generator capabilities
-        self._rf_cap = self.gen_rf.capabilities()
-        self._lo_cap = self.gen_lo.capabilities()
+        self._rf_cap = gen_rf.capabilities()
+        self._lo_cap = gen_lo.capabilities()
+
+        # Check if generators can do the required sweep.
+        key = SLVNAConfig.SWEEP_OPERATIONS.get(sweep_mode)
+        if key is not None:
+            if not self._rf_cap["operations"][key]:
+                raise NotImplementedError(f"RF generator {gen_rf} cannot perform {key.__name__}!")
+            if not self._lo_cap["operations"][key]:
+                raise NotImplementedError(f"LO generator {gen_lo} cannot perform {key.__name__}!")
+        else:
+            warning(f"Ready checks for sweep mode '{sweep_mode}' are not implemented.")
+        if gen_clk is not None and not gen_clk.capabilities()["operations"][BaseSCPIGeneratorController.continuous_wave]:
+            raise NotImplementedError(f"Clock generator {gen_clk} cannot do continuous wave!")
 
         # Use capabilities to set _deadtime and _triglen
         self._deadtime = max(
@@ -1,15 +1,48 @@
-from pythonping import ping
+"""Functions for measuring the round trip time to network devices such as the generators"""
 
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
-def network_ping_average(address: str, attempts: int = 4, timeout: float = 500.) -> float:
-    """Finds average of given amount of ping round trip times to a network device.
+VXI11_PORT = 111
+"""Port of the VXI-11 portmapper, which instruments with a `TCPIP::<address>::INSTR` VISA resource listen on"""
+
+
+def network_connect_rtt(address: str, port: int = VXI11_PORT, timeout: float = 500.) -> float:
+    """Measures the round trip time of a single TCP handshake with a network device.
 
     Args:
         address (str): network address of device (IP address, hostname, fqdn etc.);
-        attempts (int): number of tries for ping;
+        port (int): TCP port to connect to. A refused connection still gives a valid round trip time;
         timeout (float): milliseconds before attempt is marked as timeout.
 
+    Returns:
+        float: round trip time (milliseconds), or `timeout` if the device did not respond.
+    """
+    start = perf_counter()
+    try:
+        with socket.create_connection((address, port), timeout=timeout * 1E-3):
+            pass
+    except ConnectionRefusedError:
+        pass  # device responded with a reset, which took one round trip as well
+    except OSError:
+        return timeout
+    return (perf_counter() - start) * 1E3
+
+
+def network_ping_average(address: str, attempts: int = 4, timeout: float = 500., port: int = VXI11_PORT) -> float:
+    """Finds average of given amount of round trip times to a network device, measured concurrently
+    with TCP handshakes so no raw (ICMP) socket privileges are needed.
+
+    Args:
+        address (str): network address of device (IP address, hostname, fqdn etc.);
+        attempts (int): number of tries for ping;
+        timeout (float): milliseconds before attempt is marked as timeout;
+        port (int): TCP port to connect to, defaults to the VXI-11 port used by VISA instruments.
+
     Returns:
         float: average round trip time (milliseconds).
     """
-    return ping(address, timeout=1 if timeout < 1 else int(timeout), count=attempts).rtt_avg_ms
+    with ThreadPoolExecutor(max_workers=attempts) as pool:
+        rtts = list(pool.map(lambda _: network_connect_rtt(address, port, timeout), range(attempts)))
+    return sum(rtts) / attempts
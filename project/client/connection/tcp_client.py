@@ -1,11 +1,13 @@
 """Basic TCP client for retrieving measurement data"""
 
 import socket
-from struct import unpack
+from contextlib import contextmanager
+from os import environ
+from time import perf_counter_ns
 from types import TracebackType
-from typing import Type
+from typing import Iterator, Type
 
-from pythonping import ping
+import numpy as np
 
 from project.server.helpers import printd
 from project.server.protocol import TCPCommandProtocol as prot
@@ -17,66 +19,186 @@ class TCPClient:
     BUFSIZE = prot.POINTS_PER_PACKET * 32
     """Receiver buffer size in bytes = optimal packet size times the size of four (64-bits) floats"""
 
-    DEBUG = True
-    """Whether to print debugging information"""
+    DEBUG = environ.get("SLVNA_TCP_DEBUG", "1") != "0"
+    """Whether to print debugging information, can be turned off by setting the environment variable SLVNA_TCP_DEBUG=0"""
 
-    def __init__(self, host: str, port: int) -> None:
+    SOCKET_OPTIONS = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+    """Options set on the socket after connecting; Nagle's algorithm would delay every small command"""
+
+    COMMAND_END = prot.COMMAND_END.encode("utf-8")
+    """Command terminator, encoded once"""
+
+    CONFIG_PREFIXES = {cmd: cmd.encode("utf-8") for cmd in prot.TCP_PL_CONFIG_CMDS | {prot.RUN_PL}}
+    """Configuration commands encoded once, the value is appended as bytes"""
+
+    REQUEST_DATA = (prot.DATA + prot.COMMAND_END).encode("utf-8")
+    """Data request command, encoded once as it is sent for every packet"""
+
+    REQUEST_DATA_BULK = prot.DATA_BULK.encode("utf-8")
+    """Bulk data request command, encoded once; the number of points and command terminator are appended"""
+
+    REQUEST_CPU_TEMP = (prot.CPU_TEMP + prot.COMMAND_END).encode("utf-8")
+    """Server CPU temperature request command, encoded once"""
+
+    REQUEST_QUEUE_SIZE = (prot.QUEUE_SIZE + prot.COMMAND_END).encode("utf-8")
+    """Server queue size request command, encoded once"""
+
+    _quickack: bool = False
+    """Whether delayed acknowledgements are disabled after every receive (Linux only, the kernel resets it)"""
+
+    _batch: list[bytes] | None = None
+    """Commands collected inside a `with client.batch()` block, None outside such a block"""
+
+    def __init__(self, host: str, port: int, socket_options: list[tuple[int, int, int]] | None = None) -> None:
+        """Connects to the server at `host`:`port`.
+        `socket_options` are (level, option, value) tuples set after `SOCKET_OPTIONS`, for instance to enlarge SO_RCVBUF.
+        Buffer sizes are left to the kernel by default, as setting them disables automatic tuning on Linux.
+        """
         try:
             self.socket = socket.create_connection((host, port), timeout=5)
         except socket.gaierror as err:
             raise socket.gaierror(f"TCP client could not resolve address {host}:{port}.") from err
         except (ConnectionRefusedError, TimeoutError) as err:
             raise ConnectionError(f"Attempted to connect to {host}:{port}. {err.strerror}") from err
+        self._rx_view = memoryview(bytearray(TCPClient.BUFSIZE))  # Receive buffer reused by every response
+        for level, option, value in TCPClient.SOCKET_OPTIONS + (socket_options or []):
+            self.socket.setsockopt(level, option, value)
+        self._quickack = hasattr(socket, "TCP_QUICKACK")
         self._reset_trigger_config()
 
     def __enter__(self) -> "TCPClient":
         """Enters the `with` block."""
         return self
 
-    def send_receive(self, data: str) -> bytes:
+    def send_receive(self, data: str | bytes) -> bytes | None:
         """Simplest form of useful communication.
         Server expects a command from client and expects client to wait for response.
+        The command may also be given already encoded as UTF-8, without the command terminator.
+        Inside a `with client.batch()` block the command is only collected and None is returned.
         """
         if len(data) == 0:
             return b""
         if len(data) > TCPClient.BUFSIZE:
             raise ValueError(f"Data {data} is too long (> {TCPClient.BUFSIZE}).")
-        self.socket.sendall(data.encode("utf-8"))
-        return self.socket.recv(TCPClient.BUFSIZE)
+        if isinstance(data, str):
+            if self._batch is not None and data in prot.TCP_REQUEST_CMDS:
+                raise ValueError(f"Cannot send request {data} inside a batch, only configuration commands.")
+            data = data.encode("utf-8")
+        command = data + TCPClient.COMMAND_END
+        if self._batch is not None:
+            self._batch.append(command)
+            return None
+        # Copy only the received bytes out of the reused buffer, as the caller may keep the response around
+        return bytes(self.send_receive_into(command))
+
+    def send_receive_into(self, command: bytes) -> memoryview:
+        """Sends an already encoded and terminated command and receives the response into the reused receive buffer.
+        Returns a view on the response, which is only valid until the next command; copy it to keep it around.
+        """
+        if self._batch is not None:
+            raise ValueError(f"Cannot send {command} directly inside a batch.")
+        self.socket.sendall(command)
+        nbytes = self.socket.recv_into(self._rx_view)
+        self._rearm_quickack()
+        return self._rx_view[:nbytes]
+
+    @contextmanager
+    def batch(self) -> Iterator[list[bytes]]:
+        """Collects the configuration commands sent inside the `with` block and sends them in one go when it ends.
+        Yields a list which holds the response to every command after the block.
+        Nested inside another batch, the commands are simply sent with the outer batch.
+        """
+        if self._batch is not None:
+            yield []
+            return
+        responses = []
+        self._batch = []
+        try:
+            yield responses
+            commands = self._batch
+        finally:
+            self._batch = None
+        if not commands:
+            return
+        self.socket.sendall(b"".join(commands))
+        # Every configuration command is answered with a single response byte, received into the reused receive buffer
+        for start in range(0, len(commands), TCPClient.BUFSIZE):
+            received = self._rx_view[:min(len(commands) - start, TCPClient.BUFSIZE)]
+            self._receive_exactly(received)
+            responses.extend(bytes(received[i:i + 1]) for i in range(len(received)))
 
     def start_acquisition(self) -> None:
         """Requests programmable logic to start acquisition."""
-        if self.send_receive(f"{prot.RUN_PL}1") != prot.RESPONSE_OK:
+        if self._send_config(prot.RUN_PL, 1) != prot.RESPONSE_OK:
             raise RuntimeError("SoC refused to start acquisition, check configuration!")
 
     def stop_acquisition(self) -> None:
         """Requests programmable logic to stop acquisition."""
-        self.send_receive(f"{prot.RUN_PL}0")
+        self._send_config(prot.RUN_PL, 0)
 
-    def request_data(self) -> tuple[float, float, float, float]:
+    def request_data(self) -> np.ndarray:
         """Asks server for acquired data."""
-        out = self.send_receive(prot.DATA)
+        out = self.send_receive_into(TCPClient.REQUEST_DATA)
         # This should be 32 bytes or an integer multiple (in case of multiple samples).
         if len(out) % 32 != 0:
             raise RuntimeError(f"TCP expected a multiple of 32 bytes (4 values), but got {len(out)}!")
-        return self.unpack_floats(out)
+        return self.unpack_floats(out).copy()  # Copy out of the reused receive buffer
+
+    def request_data_bulk(self, points: int, out: np.ndarray | None = None) -> np.ndarray:
+        """Asks server for `points` points, requesting up to `POINTS_PER_PACKET` missing points at a time,
+        and writes them directly into `out` (a new array if None).
+        `out` should be a C-contiguous float64 array of shape (n, 4) with n at least `points`.
+        Returns the part of `out` holding the points.
+        """
+        if out is None:
+            out = np.empty((points, 4), dtype=np.float64)
+        buffer, header = memoryview(out).cast("B"), self._rx_view[:4]
+        points_done = 0
+        while points_done < points:
+            # Bounded, so the server answers before the socket times out however long the sweep takes
+            request = min(points - points_done, prot.POINTS_PER_PACKET)
+            self.socket.sendall(TCPClient.REQUEST_DATA_BULK + b"%d" % request + TCPClient.COMMAND_END)
+            nbytes = self.socket.recv_into(header)
+            if nbytes > 0 and header[0] == prot.RESPONSE_ERR[0]:  # A point count never starts with this byte
+                raise RuntimeError("SoC refused data request, is the acquisition running?")
+            self._receive_exactly(header[nbytes:])
+            count = int.from_bytes(header, byteorder="big")
+            self._receive_exactly(buffer[points_done * 32:(points_done + count) * 32])
+            points_done += count
+        return out[:points]
+
+    def _receive_exactly(self, buffer: memoryview) -> None:
+        """Receives until `buffer` is completely filled."""
+        nbytes = 0
+        while nbytes < len(buffer):
+            received = self.socket.recv_into(buffer[nbytes:])
+            if received == 0:
+                raise ConnectionError(f"Server closed the connection after {nbytes} of {len(buffer)} bytes!")
+            nbytes += received
+        self._rearm_quickack()
+
+    def _rearm_quickack(self) -> None:
+        """Disables delayed acknowledgements again after a receive, as the kernel resets TCP_QUICKACK."""
+        if self._quickack:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
 
     def send_tpp(self, time: float) -> None:
         """Configures time per point in seconds. Note: rounded to nearest microsecond!"""
-        self.send_receive(f"{prot.TPP}{time*1E6:.0f}")
+        self._send_config(prot.TPP, round(time * 1E6))
 
     def send_dead_time(self, time: float) -> None:
         """Configures deadtime in seconds. Note: rounded to nearest microsecond!"""
-        self.send_receive(f"{prot.DEAD_TIME}{time*1E6:.0f}")
+        self._send_config(prot.DEAD_TIME, round(time * 1E6))
 
     def send_trigger_length(self, time: float) -> None:
         """Configures trigger pulse length in seconds. Note: rounded to nearest microsecond!"""
-        self.send_receive(f"{prot.TRIG_LEN}{time*1E6:.0f}")
+        self._send_config(prot.TRIG_LEN, round(time * 1E6))
 
     def _reset_trigger_config(self) -> None:
         """Disables trigger outputs."""
-        self.send_receive(f"{prot.TRIG_0_CONF}0")  # no trigger output
-        self.send_receive(f"{prot.TRIG_1_CONF}0")  # no trigger output
+        with self.batch():
+            self._send_config(prot.TRIG_0_CONF, 0)  # no trigger output
+            self._send_config(prot.TRIG_1_CONF, 0)  # no trigger output
 
     def send_trigger_config(self, trig_nr: int, positive: bool, sweep: bool = True, step: bool = True) -> None:
         """Configure an output trigger (either 0 or 1).
@@ -95,26 +217,35 @@ class TCPClient:
             bits |= 0b0010
         if step:
             bits |= 0b0100
-        self.send_receive(f"{char}{bits}")
+        self._send_config(char, bits)
+
+    def _send_config(self, cmd: str, value: int) -> bytes | None:
+        """Sends configuration command `cmd` with an integer `value`, without formatting or encoding strings."""
+        return self.send_receive(TCPClient.CONFIG_PREFIXES[cmd] + b"%d" % value)
 
     def get_queue_size(self) -> int:
         """Queries DMA buffer queue size."""
-        return int.from_bytes(self.send_receive(prot.QUEUE_SIZE), byteorder="big")
+        return int.from_bytes(self.send_receive_into(TCPClient.REQUEST_QUEUE_SIZE), byteorder="big")
 
     def get_server_cpu_temp(self) -> float:
         """Queries server's SoC temperature."""
-        return self.unpack_floats(self.send_receive(prot.CPU_TEMP))[0]
+        return float(self.unpack_floats(self.send_receive_into(TCPClient.REQUEST_CPU_TEMP))[0])
 
-    def ping(self) -> float:
+    def ping(self, count: int = 5) -> float:
         """Returns the network latency in seconds between the client and server, aka ping.
-        Returns timeout length if no connection could be made (1 second).
+        Measured as the average round trip time of `count` queue size requests over the existing connection,
+        which needs no ICMP privileges and includes the response time of the server itself.
         """
-        return ping(self.socket.getpeername(), timeout=1, count=5).rtt_avg
+        send_receive_into, request = self.send_receive_into, TCPClient.REQUEST_QUEUE_SIZE
+        start = perf_counter_ns()
+        for _ in range(count):
+            send_receive_into(request)
+        return (perf_counter_ns() - start) / count * 1E-9
 
     @staticmethod
-    def unpack_floats(by: bytes) -> tuple[float, float, float, float]:
-        """Converts multiples of 8 bytes to 64-bit floating point numbers."""
-        return unpack(f"{len(by) // 8}d", by)
+    def unpack_floats(by: bytes) -> np.ndarray:
+        """Converts multiples of 8 bytes to 64-bit floating point numbers, as a read-only view on `by`."""
+        return np.frombuffer(by, dtype=np.float64, count=len(by) // 8)
 
     def _stop_server(self, really: bool = False) -> bool:
         """Stops TCP server. Be careful, you have to restart the server manually if stopped!
@@ -122,7 +253,7 @@ class TCPClient:
         """
         if really:
             # Server should return empty byte string only if it shut down itself correctly.
-            return self.socket.send(prot.STOP_SERVER.encode())
+            return self.socket.send((prot.STOP_SERVER + prot.COMMAND_END).encode())
         return False
 
     def __exit__(
@@ -132,5 +263,5 @@ class TCPClient:
         if TCPClient.DEBUG:
             printd("TCP client exiting.")
             if exc_type is not None:
-                printd(f"Exception occured: {type(exc_val).__name__}: {' '.join(exc_val.args)}")
+                printd(f"Exception occured: {type(exc_val).__name__}: {exc_val}")
         self.socket.close()
@@ -1,16 +1,17 @@
 """Module for controlling RF generators from AnaPico"""
 
 from inspect import signature
-from re import sub
+from re import compile as re_compile
 from sys import platform
-from typing import Callable
+from typing import TYPE_CHECKING, Callable
 from warnings import warn
 
-import pyvisa
-
 from project.client.connection.ping import network_ping_average
 from project.client.generator.base_controller import BaseSCPIGeneratorController
 
+if TYPE_CHECKING:  # pyvisa takes long to import, so it is only imported once a generator connects
+    import pyvisa
+
 
 class APUASYN20Controller(BaseSCPIGeneratorController):
     """Programmer manual: https://www.anapico.com/download/pm_signal-generators/?wpdmdl=6829&refresh=665ecb7bc31c21717488507"""
@@ -18,6 +19,9 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
     OUT_REF_FREQ_RANGE: tuple[float, float] = (100E6, 100E6)
     """Range of frequencies this generator supports in its output clock reference."""
 
+    IPV4_PATTERN = re_compile(r"((25[0-5]|(2[0-4]|1\d|[1-9]|)\d)\.){3}(25[0-5]|(2[0-4]|1\d|[1-9]|)\d)")
+    """Matches an IPv4 address inside a VISA resource address, compiled once."""
+
     def __init__(self, resource_addr: str, **kwargs) -> None:
         """Initialise an APUASYN20 generator with VISA `resource_addr`
         and optionally configure its reference oscillator settings via keyword arguments.
@@ -25,15 +29,15 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
         super().__init__(f"APUASYN20 @ {resource_addr}, not yet connected.")
         self.resource_addr = resource_addr
         self.resource_info = "A not yet connected APUASYN20 RF generator."
-        self.gen: pyvisa.Resource | None = None
+        self.gen: "pyvisa.Resource | None" = None
         self.mode: Callable | None = None
 
         # Process kwargs.
-        possible_kwarg_keys = set(signature(self.configure_ref_osc).parameters.keys())
-        if not set(kwargs.keys()).issubset(possible_kwarg_keys):
+        possible_kwarg_keys = APUASYN20Controller.REF_OSC_KWARGS
+        if not possible_kwarg_keys.issuperset(kwargs.keys()):
             raise ValueError(
                 f"{self} does not support kwargs "
-                f"{set(kwargs.keys()).difference(possible_kwarg_keys)}, only {possible_kwarg_keys}."
+                f"{set(kwargs.keys()).difference(possible_kwarg_keys)}, only {set(possible_kwarg_keys)}."
             )
 
         # Send reference configuration by setting up a temporary connection with the generator.
@@ -47,34 +51,40 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
             return f"APUASYN20Controller({self.__dict__})"
         return (
             f"APUASYN20Controller(\n\t{self.__dict__},\n\tlocked={self.is_locked()},\n\t" +
-            f"trig_type={self.gen.query('TRIG_TYPE?')}),\n\tosc={self.gen.query('ROSC_SOUR?')}\n)"
+            f"trig_type={self.query('TRIG_TYPE?')}),\n\tosc={self.query('ROSC_SOUR?')}\n)"
         )
 
+    CAPABILITIES: dict = {
+        "operations": {
+        BaseSCPIGeneratorController.continuous_wave: True,
+        BaseSCPIGeneratorController.fsweep: True,
+        BaseSCPIGeneratorController.psweep: False
+        },
+        "constants": {
+        BaseSCPIGeneratorController.DEADTIME: 500E-6
+        },
+        "trigger": {
+        "length": 10E-6,
+        "polarity": True,
+        "first": True,
+        "remaining": True
+        }
+    }
+    """Capabilities of this generator, built once as they never change. Do not modify!"""
+
     @staticmethod
     def capabilities() -> dict:
-        return {
-            "operations": {
-            BaseSCPIGeneratorController.continuous_wave: True,
-            BaseSCPIGeneratorController.fsweep: True,
-            BaseSCPIGeneratorController.psweep: False
-            },
-            "constants": {
-            BaseSCPIGeneratorController.DEADTIME: 500E-6
-            },
-            "trigger": {
-            "length": 10E-6,
-            "polarity": True,
-            "first": True,
-            "remaining": True
-            }
-        }
+        return APUASYN20Controller.CAPABILITIES
 
     def continuous_wave(self, freq: float, power: float) -> None:
         self._check_conn()
 
-        self.gen.write(f"POW:AMPL {power}DBM")  # RF output power in dBm
-        self.gen.write("FREQ:MODE FIX")  # frequency mode: fixed frequency
-        self.gen.write(f"SOUR:FREQ {freq}Hz")  # frequency in Hz
+        commands = [
+            f"POW:AMPL {power}DBM",  # RF output power in dBm
+            "FREQ:MODE FIX",  # frequency mode: fixed frequency
+            f"SOUR:FREQ {freq}Hz",  # frequency in Hz
+        ]
+        self.gen.write(APUASYN20Controller._join(*commands))
         self.mode = APUASYN20Controller.continuous_wave
 
     def fsweep(self, start_freq: float, stop_freq: float, power: float, points: float, timestep: float) -> None:
@@ -90,25 +100,34 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
         """
         self._check_conn()
 
+        deadtime = APUASYN20Controller.CAPABILITIES["constants"][BaseSCPIGeneratorController.DEADTIME]
+        if timestep <= deadtime:  # Fail before sending anything rather than on a generator error
+            raise ValueError(f"Timestep {timestep}s of {self.name} should be larger than its dead time {deadtime}s.")
+
+        commands = []
         if stop_freq < start_freq:
             start_freq, stop_freq = stop_freq, start_freq
-            self.gen.write("SWE:DIR DOWN")  # from highest to lowest frequency
-        self.gen.write(f"POW:AMPL {power}DBM")  # RF output power in dBm
-        self.gen.write(f"FREQ:STAR {start_freq}Hz")  # start frequency in hertz
-        self.gen.write(f"FREQ:STOP {stop_freq}Hz")  # stop frequency in hertz
-        self.gen.write(f"SWE:POIN {points}")  # number of points in the sweep
-        deadtime = APUASYN20Controller.capabilities().get("deadtime", 0)
-        self.gen.write(f"SWE:DWEL {timestep - deadtime}s")
+            commands.append("SWE:DIR DOWN")  # from highest to lowest frequency
+        commands += [
+            f"POW:AMPL {power}DBM",  # RF output power in dBm
+            f"FREQ:STAR {start_freq}Hz",  # start frequency in hertz
+            f"FREQ:STOP {stop_freq}Hz",  # stop frequency in hertz
+            f"SWE:POIN {points}",  # number of points in the sweep
+            f"SWE:DWEL {timestep - deadtime}s",
+        ]
+        self.gen.write(APUASYN20Controller._join(*commands))
         self.mode = APUASYN20Controller.fsweep  # Set mode here because FREQ:MODE SWE has to be sent later.
 
     def query(self, parameter: str) -> float | str:
         self._check_conn()
 
-        result = self.gen.query(parameter)
+        # Raw write and read skip the string termination handling of pyvisa; float() parses bytes directly
+        self.gen.write_raw(parameter.encode("ascii") + self._write_end)
+        result = self.gen.read_raw()
         try:
             return float(result)
         except (ValueError, OverflowError):
-            return result
+            return result.decode("ascii").rstrip()
 
     def rf_on(self) -> None:
         self._check_conn()
@@ -116,11 +135,11 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
             warn(f"Turning RF on for {self.gen} that is not locked!")
 
         # Enable the RF output. Important: this has to be done before FREQ:MODE SWE!
-        self.gen.write("OUTP 1")
-
         # Set mode based on instance attribute.
         if self.mode == APUASYN20Controller.fsweep:
-            self.gen.write("FREQ:MODE SWE")
+            self.gen.write(APUASYN20Controller._join("OUTP 1", "FREQ:MODE SWE"))
+        else:
+            self.gen.write("OUTP 1")
 
     def rf_off(self) -> None:
         self._check_conn()
@@ -129,11 +148,14 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
     def configure_trigger(self, enabled: bool | None = None, on_each_point: bool | None = None) -> None:
         self._check_conn()
 
+        commands = []
         if enabled is not None:  # trigger source: external (requires rising edge on trigger)
-            self.gen.write(f"TRIG:SOUR {'EXT' if enabled else 'IMM'}")  # or immediate (no trigger)
+            commands.append(f"TRIG:SOUR {'EXT' if enabled else 'IMM'}")  # or immediate (no trigger)
         if on_each_point is not None:  # trigger type: each trigger starts step (POINT)
-            self.gen.write(f"TRIG:TYPE {'POINT' if on_each_point else 'NORM'}")  # or sweep (NORM)
-            self.gen.write("INIT:CONT ON")  # trigger arming: always armed after first point
+            commands.append(f"TRIG:TYPE {'POINT' if on_each_point else 'NORM'}")  # or sweep (NORM)
+            commands.append("INIT:CONT ON")  # trigger arming: always armed after first point
+        if commands:
+            self.gen.write(APUASYN20Controller._join(*commands))
 
     def configure_ref_osc(
         self,
@@ -144,12 +166,13 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
     ) -> None:
         self._check_conn()
 
+        commands = []
         if ref_out_enabled is not None:
-            self.gen.write(f"ROSC:OUTP:STAT {'ON' if ref_out_enabled else 'OFF'}")
+            commands.append(f"ROSC:OUTP:STAT {'ON' if ref_out_enabled else 'OFF'}")
         if ext_ref_listen is not None:
-            self.gen.write(f"ROSC:SOUR {'EXT' if ext_ref_listen else 'INT'}")  # set external reference clock
+            commands.append(f"ROSC:SOUR {'EXT' if ext_ref_listen else 'INT'}")  # set external reference clock
         if in_freq is not None:
-            self.gen.write(f"ROSC:EXT:FREQ {in_freq}Hz")
+            commands.append(f"ROSC:EXT:FREQ {in_freq}Hz")
         if out_freq is not None:
             low, high = APUASYN20Controller.OUT_REF_FREQ_RANGE
             if low < out_freq or out_freq > high:
@@ -157,12 +180,18 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
                     f"{self.name} does not support output reference frequency {out_freq}, "
                     f"only in range {APUASYN20Controller.OUT_REF_FREQ_RANGE}."
                 )
-            self.gen.write(f"ROSC:OUTP:FREQ {out_freq}Hz")
+            commands.append(f"ROSC:OUTP:FREQ {out_freq}Hz")
+        if commands:
+            self.gen.write(APUASYN20Controller._join(*commands))
+
+    REF_OSC_KWARGS = frozenset(signature(configure_ref_osc).parameters) - {"self"}
+    """Keyword arguments accepted by `configure_ref_osc` and thus by the initialiser, inspected once."""
 
     def start(self) -> None:
         if self.gen is not None:
             warn(f"Already initialised connection to {self} before, skipping start() method.")
             return  # Already initialised before.
+        import pyvisa
         if platform.startswith("win"):  # Windows
             rm = pyvisa.ResourceManager()
         elif platform.startswith("darwin"):  # MacOS
@@ -182,6 +211,7 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
                 f"Ping average round trip time to {ip}: {rtt} ms" if rtt is not None else ""
             ) from err
 
+        self._write_end = self.gen.write_termination.encode("ascii")  # appended by `query` to raw writes
         self.gen.write("*RST")  # reset the generator, otherwise power cannot be modified
         self.gen.write("*CLS")  # clear status byte
 
@@ -194,6 +224,7 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
 
     def stop(self) -> None:
         if self.gen is not None:
+            import pyvisa
             try:
                 _ = self.gen.session
                 self.rf_off()
@@ -206,6 +237,13 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
     def is_locked(self) -> bool:
         return float(self.query("ROSC:LOCK?")) == 1.  # Can only ever be 0.0 or 1.0.
 
+    @staticmethod
+    def _join(*commands: str) -> str:
+        """Joins SCPI commands into one compound message, so they are sent in a single VISA write.
+        The colon after each separator makes the generator interpret the next command from the root.
+        """
+        return ";:".join(commands)
+
     def _check_conn(self) -> None:
         """Checks if the user connected to the generator to be able to send SCPI."""
         if self.gen is None:
@@ -215,9 +253,9 @@ class APUASYN20Controller(BaseSCPIGeneratorController):
         """Pings the generator, if `self.resource_addr` contains an IPv4 address.
         Returns extracted IPv4 address and average round trip time in seconds (else None).
         """
-        ip_address = sub(r"([^0-9]*)(((25[0-5]|(2[0-4]|1\d|[1-9]|)\d)\.?\b){4})(.*)", r"\2", self.resource_addr)
-        if ip_address != self.resource_addr:
-            return ip_address, 1E-3 * network_ping_average(ip_address)
+        match = APUASYN20Controller.IPV4_PATTERN.search(self.resource_addr)
+        if match is not None:
+            return match[0], 1E-3 * network_ping_average(match[0])
         return f"[no ipv4 address inside {self.resource_addr}]", None
 
     def __enter__(self) -> "BaseSCPIGeneratorController":
@@ -1,8 +1,8 @@
 """Classes and functions for fetching and storing acquired data from programmable logic (PL)"""
 
-from queue import Full, Queue
+import asyncio
+from queue import Empty, Queue
 from threading import Event
-from time import sleep
 
 from pynq import MMIO, Overlay, allocate
 
@@ -20,19 +20,43 @@ class PLInterface(PLConfig):
     DEBUG = True
     """Whether to print debugging information"""
 
-    def __init__(self) -> None:
+    DMA_PACKET_DTYPE = np.dtype([("value", "<i8"), ("count", "<u4")])
+    """Layout of the 3 little-endian words per value in the DMA buffer: a signed 64-bit value and its sample count"""
+
+    def __init__(self, dma_interrupt: bool = False) -> None:
         # Load overlay
         self.ol = Overlay(PLInterface.OVERLAY_PATH)
         # Create MMIO objects for config registers
         self.mmios = {key: MMIO(value) for key, value in PLInterface.MMIO_ADDRESSES_DICT.items()}
-        # Create DMA object and buffer
+        # Resolve the location of every MMIO field once as (scalar, mmio, bitshift, mask)
+        self._fields = {}
+        for cmd, field in PLInterface.MMIO_FIELD_DICT.items():
+            mask = field["mask"]
+            # Little bithack to get trailing zeros of mask (https://stackoverflow.com/a/63552117)
+            bitshift = (mask & -mask).bit_length() - 1
+            self._fields[cmd] = field["scale"], self.mmios[field["mmio"]], bitshift, mask
+        # Last value written to every MMIO register, so writes don't have to read the register first
+        self._resync_mmio()
+        # Create DMA object and buffer, which is a view on the start of a (larger) contiguous allocation
         self.dma_channel = self.ol.dma.recvchannel
-        self.dma_output_buffer = allocate(shape=(PLConfig.DMA_PACKET_LENGTH + 4, ), dtype=PLInterface.DMA_DTYPE)
+        # With `dma_interrupt`, wait for transfers on the interrupt of the channel instead of polling the DMA status,
+        # on an event loop that is reused for every transfer until `close`
+        self._dma_loop = asyncio.new_event_loop() if dma_interrupt else None
+        self._dma_pool = allocate(shape=(PLConfig.DMA_PACKET_LENGTH + 4, ), dtype=PLInterface.DMA_DTYPE)
+        self._use_dma_buffer(self._dma_pool)
+        # Output buffer for the voltages of a single transfer, reused as the queue copies the values out of it
+        self._volts = np.empty(PLConfig.DMA_PACKET_LENGTH // 3, dtype=np.float64)
         # Set state to idle
         self._enabled = False
         self._first_dma = False
         self._dma_status = 2  # default: after DMA transfer
 
+    def close(self) -> None:
+        """Closes the event loop used to wait for DMA interrupts, after which transfers poll the DMA status instead."""
+        if self._dma_loop is not None:
+            self._dma_loop.close()
+            self._dma_loop = None
+
     @property
     def points_per_transfer(self):
         """Amount of points per DMA transfer."""
@@ -45,10 +69,14 @@ class PLInterface(PLConfig):
         if value < 1: value = 1
         # Write to PL
         self.write_mmio(TCPCommandProtocol.PPT, value)
-        # Change buffer size (aka delete and reallocate)
-        if hasattr(self, "dma_output_buffer"): del self.dma_output_buffer
-        # Allocate 4 more words than technically necessary to fit
-        self.dma_output_buffer = allocate(shape=(value * PLConfig.DMA_PACKET_LENGTH + 4, ), dtype=PLInterface.DMA_DTYPE)
+        # Change buffer size, 4 more words than technically necessary to fit. Only reallocate if the allocation is too small,
+        # else take a view on its start (which has the same physical address) to avoid fragmenting contiguous memory
+        words = value * PLConfig.DMA_PACKET_LENGTH + 4
+        if len(self._dma_pool) < words:
+            del self.dma_output_buffer, self._dma_first_data, self._dma_data, self._dma_pool
+            self._dma_pool = allocate(shape=(words, ), dtype=PLInterface.DMA_DTYPE)
+        self._use_dma_buffer(self._dma_pool[:words])
+        self._volts = np.empty(value * PLConfig.DMA_PACKET_LENGTH // 3, dtype=np.float64)
 
     @property
     def enable(self):
@@ -73,7 +101,9 @@ class PLInterface(PLConfig):
         else: helpers.printd("Stopped programmable logic data acquisition.")
 
     def get_data(self) -> np.ndarray:
-        """Get data from the DMA converted to volts. Returns numpy array of floats representing voltages."""
+        """Get data from the DMA converted to volts. Returns numpy array of floats representing voltages.
+        The array is reused for every transfer, so it must be consumed (e.g. copied into the queue) before the next call.
+        """
         # The first transfer has 4 words of garbage prepended because that stays stuck in the DMA during reset
         if not self.enable:
             raise PLInterface.DMANotAllowed("[DMA] Cannot do a DMA transfer if PL isn't enabled!")
@@ -81,87 +111,78 @@ class PLInterface(PLConfig):
         if self._first_dma:
             if PLInterface.DEBUG: helpers.printd("First DMA data request")
             self._first_dma = False
-            return self.preprocess_raw_dma_data(self._raw_dma_request(first=True))
-        return self.preprocess_raw_dma_data(self._raw_dma_request(first=False))
+            return self.preprocess_raw_dma_data(self._raw_dma_request(first=True), out=self._volts)
+        return self.preprocess_raw_dma_data(self._raw_dma_request(first=False), out=self._volts)
 
     def _raw_dma_request(self, first):
         """Reads data from a direct memory access channel.
-        First read has to be different because of a quirk with the DMA controller for Zynq chips."""
+        First read has to be different because of a quirk with the DMA controller for Zynq chips.
+        Transfers are deliberately not double-buffered: a transfer left in flight when fetching pauses would never finish
+        once the PL is disabled, and stopping the DMA channel bricks it (see `TCPDataServer.pause_dma`)."""
         try:
             # No timeout available in `wait`; use dma_channel.stop() outside thread to stop.
             self._dma_status = 0
             self.dma_channel.transfer(self.dma_output_buffer)
             self._dma_status = 1
-            self.dma_channel.wait()
+            if self._dma_loop is None:
+                self.dma_channel.wait()
+            else:
+                self._dma_loop.run_until_complete(self.dma_channel.wait_async())
             self._dma_status = 2
         except RuntimeError as err:
             # This occurs when the programmable logic just started after reset and did not yet configure the DMA channel.
             raise PLInterface.DMANotAllowed from err
         # Cut off garbage
-        if first:
-            # If first skip first 4 elements that were stuck in the DMA
-            return self.dma_output_buffer[4:]
-        else:
-            # If not first skip last 4 that weren't overwritten this transfer
-            return self.dma_output_buffer[:-4]
+        return self._dma_first_data if first else self._dma_data
+
+    def _use_dma_buffer(self, buffer):
+        """Transfers into `buffer` from now on, and prepares the views on the data it will contain."""
+        self.dma_output_buffer = buffer
+        # If first skip first 4 elements that were stuck in the DMA,
+        # if not first skip last 4 that weren't overwritten this transfer
+        self._dma_first_data, self._dma_data = buffer[4:], buffer[:-4]
 
     @staticmethod
-    def preprocess_raw_dma_data(buffer) -> np.ndarray:
+    def preprocess_raw_dma_data(buffer, out=None) -> np.ndarray:
         """Converts sets of 3 raw words from the DMA buffer to a float representing voltage.
         Every uint64 value is divided by the corresponding count and multiplied by a conversion factor.
+        The voltages are written into `out` if given, which should be a float64 array of a third of the buffer length.
         """
-        # volts = [
-        #     (
-        #         helpers.uint64_to_signed_int(
-        #             int(buffer[i])  # to Python integer(first entry: unsigned 32-bit integer
-        #             + (int(buffer[i + 1]) << 32)  # adding second unsigned integer shifted left 32 bits)
-        #         ) / buffer[i + 2]  # dividing by third entry (count)
-        #         * PLInterface.RAW_TO_VOLTS  # scaling to units of volts
-        #     ) for i in range(0, len(buffer), 3)  # i = 0, 3, 6, 9
-        # ]
-
         assert len(buffer) % 3 == 0, "[DMA] Buffer length not a multiple of 3???"
 
-        # Allocate new buffer of float64s, output
-        volts = np.empty(len(buffer) // 3, dtype=np.float64)
+        # Reinterpret every 3 words as a packed (signed 64-bit value, count) record, no copy or shifting needed
+        packets = np.ascontiguousarray(buffer).view(PLInterface.DMA_PACKET_DTYPE)
 
-        # Index into volts and buffer
-        for i, j in enumerate(range(0, len(buffer), 3)):
-            # Create a single signed int from the first two values in the buffer
-            val = helpers.uint64_to_signed_int((int(buffer[j + 1]) << 32) + int(buffer[j]))
-            # Divide by the amount of samples for this value and multiply to convert to volts
-            volts[i] = val / buffer[j + 2] * PLConfig.RAW_TO_VOLTS
+        # Divide by the amount of samples for this value and multiply to convert to volts, in two passes without temporaries
+        volts = np.divide(packets["value"], packets["count"], out=out)
+        volts *= PLConfig.RAW_TO_VOLTS
 
         return volts
 
     def _resolve_field(self, cmd) -> tuple:
         """Resolves the location in MMIO of the field corresponding to the provided TCP command."""
-        # Get field info from dict
-        dict = PLInterface.MMIO_FIELD_DICT.get(cmd)
-        if dict is None:
+        field = self._fields.get(cmd)
+        if field is None:
             raise KeyError(f"[MMIO] Command {cmd} does not exist in MMIO_FIELD_DICT!")
-        scalar, mmio_idx, mask = dict["scale"], dict["mmio"], dict["mask"]
-        # Resolve MMIO
-        mmio = self.mmios[mmio_idx]
-        # Little bithack to get trailing zeros of mask (https://stackoverflow.com/a/63552117)
-        bitshift = (mask & -mask).bit_length() - 1
-        return scalar, mmio, bitshift, mask
+        return field
 
     def write_mmio(self, cmd, value) -> None:
         """Resolves the provided MMIO field and writes a value there."""
         # Get field information
         scalar, mmio, bitshift, mask = self._resolve_field(cmd)
         # Scale value to internal arbitrary units
-        if not float(value * scalar).is_integer():
-            helpers.printd(f"[MMIO] Trying to write non-integer value {value*scalar:.2f} to field {cmd}, rounding!")
-        value = round(value * scalar)
+        scaled = value * scalar
+        value = round(scaled)
+        if value != scaled:
+            helpers.printd(f"[MMIO] Trying to write non-integer value {float(scaled):.2f} to field {cmd}, rounding!")
         if value > (mask >> bitshift):
             raise ValueError(f"[MMIO] Value {value} is too large for field {cmd}!")
-        # Merge value with the data already there
-        curr_data = mmio.read()
+        # Merge value with the data already there, which is known from the last write
+        curr_data = self._mmio_shadow[mmio]
         new_data = (curr_data & ~mask) | (value << bitshift & mask)
         # Write out new data to the register
         mmio.write(offset=0, data=new_data)
+        self._mmio_shadow[mmio] = new_data
         helpers.printd(f"Wrote 0x{new_data:08x} to 0x{mmio.base_addr:08x} (command {cmd})")
 
     def read_mmio(self, cmd) -> float:
@@ -172,10 +193,14 @@ class PLInterface(PLConfig):
         curr_data = mmio.read()
         value = (curr_data & mask) >> bitshift
         # Scale value to real units and return
-        value /= scalar
+        value = float(value / scalar)
         helpers.printd(f"Read {value:.2f} from 0x{mmio.base_addr:08x} (command {cmd})")
         return value
 
+    def _resync_mmio(self) -> None:
+        """Reads all MMIO registers into the copy used by `write_mmio`."""
+        self._mmio_shadow = {mmio: mmio.read() for mmio in self.mmios.values()}
+
     def get_mmio_status(self) -> dict:
         """Returns dictionary with hexadecimal addresses and corresponding current binary contents of all MMIO registers."""
         return {f"0x{m.base_addr:08x}": f"0b{m.read():>032b}" for m in self.mmios.values()}
@@ -203,7 +228,10 @@ class PLInterface(PLConfig):
 
 
 class DataQueue(Queue):
-    """First-in first-out structure storing acquired data"""
+    """First-in first-out ring buffer storing acquired data as points of 4 voltages (Idut, Qdut, Iref, Qref).
+    Only the mutex and `not_empty` condition of `Queue` are used; store and retrieve data with `put_points` and `get_points`.
+    There is a single producer (the fetch thread), which never blocks, and a single consumer (the TCP server).
+    """
 
     MAXSIZE_BITS = 16
     """Maximum size of the queue is 2 ** BITSIZE - 1"""
@@ -226,18 +254,57 @@ class DataQueue(Queue):
         self.exit = Event()
         self.exit.clear()
 
+    def _init(self, maxsize):
+        # Called by `Queue.__init__`: preallocate the ring of points instead of a deque of items
+        self._ring = np.empty((maxsize, 4))
+        self._ring.fill(0)  # Touch every page now, instead of page faulting the first time the ring fills while streaming
+        self._head = 0  # Index of the oldest point in the ring
+        self._count = 0  # Number of points in the ring
+
+    def _qsize(self):
+        return self._count
+
     @property
     def starting_or_started(self):
         """True if we're currently fetching or about to start"""
         return self.fetch.is_set() or not self.paused.is_set()
 
+    def put_points(self, points):
+        """Copies as many points (rows of an array with shape (n, 4)) into the queue as fit, without blocking.
+        Returns the number of points stored.
+        """
+        with self.mutex:
+            amount = min(len(points), self.maxsize - self._count)
+            tail = (self._head + self._count) % self.maxsize
+            first = min(amount, self.maxsize - tail)  # Points that fit before wrapping around
+            self._ring[tail:tail + first] = points[:first]
+            self._ring[:amount - first] = points[first:amount]
+            self._count += amount
+            if amount:
+                self.not_empty.notify()
+            return amount
+
+    def get_points(self, out, timeout=None):
+        """Moves up to `len(out)` of the oldest points from the queue into the array `out` with shape (n, 4).
+        Waits up to `timeout` seconds for data and returns the number of points moved; raises `Empty` if there is none.
+        """
+        with self.not_empty:
+            if not self.not_empty.wait_for(self._qsize, timeout):
+                raise Empty
+            amount = min(len(out), self._count)
+            first = min(amount, self.maxsize - self._head)  # Points that can be read before wrapping around
+            out[:first] = self._ring[self._head:self._head + first]
+            out[first:amount] = self._ring[:amount - first]
+            self._head = (self._head + amount) % self.maxsize
+            self._count -= amount
+            return amount
+
     def flush(self):
         """Removes all items in the queue."""
         with self.mutex:
-            # TODO: The clear() method isn't documented so we should probably do this differently
-            self.queue.clear()
+            self._head = self._count = 0
         if not self.empty():
-            raise RuntimeError(f"[QUEUE] Emptying queue failed; size is {self.queue.qsize()} > 0.")
+            raise RuntimeError(f"[QUEUE] Emptying queue failed; size is {self.qsize()} > 0.")
         if DataQueue.DEBUG: helpers.printd("[QUEUE] Queue flushed.")
 
     def keep_fetching(self, fetch_func):
@@ -249,9 +316,9 @@ class DataQueue(Queue):
             # If we're instructed to pause do so
             if not self.fetch.is_set():
                 self.paused.set()
-                # Wait to unpause or exit
-                while not self.fetch.is_set() and not self.exit.is_set():
-                    sleep(0)  # yield to other threads
+                # Wait to unpause or exit, blocking instead of spinning; the timeout bounds how long noticing an exit takes
+                while not self.fetch.wait(DataQueue.QUEUE_TIMEOUT) and not self.exit.is_set():
+                    pass
                 if self.exit.is_set():
                     break
                 # Continue fetching
@@ -262,18 +329,17 @@ class DataQueue(Queue):
                 new = fetch_func()
             except PLInterface.DMANotAllowed:
                 helpers.verbose("[QUEUE] Got DMA error when trying to fetch!")
+                continue
 
-            # Put new data in queue as a tuple per point
+            # Put the whole transfer in the queue at once, as rows of 4 voltages per point
             if len(new) % 4 != 0:
                 raise ValueError("[QUEUE] fetch_func() returned a non-integer amount of points!")
-            for i in range(0, len(new), 4):
-                try:
-                    self.put_nowait((new[i], new[i + 1], new[i + 2], new[i + 3]))
-                except Full:
-                    # If the queue is full it pauses fetching, the server should notice and reply error
-                    helpers.printd("[QUEUE] Queue is full! Pausing DMA")
-                    self.fetch.clear()
-                    self.paused.set()
+            points = np.reshape(new, (-1, 4))
+            if self.put_points(points) < len(points):
+                # If the queue is full it pauses fetching, the server should notice and reply error
+                helpers.printd("[QUEUE] Queue is full! Pausing DMA")
+                self.fetch.clear()
+                self.paused.set()
 
         # If we get here we're exiting the thread
         self.paused.set()  # Signal to the main server thread that we're not acquiring anymore! Hangs otherwise!
@@ -8,10 +8,18 @@ from subprocess import run
 VERBOSE = False
 """Whether to spam your console with messages"""
 
+_second_prefix = (None, "")
+"""Last second printed by printd() and its formatted date and time, as formatting only changes once per second"""
+
 
 def printd(*args, **kwargs):
     """Prints date and time in front of message."""
-    out = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    global _second_prefix
+    now = datetime.now()
+    second = now.replace(microsecond=0)
+    if second != _second_prefix[0]:
+        _second_prefix = (second, second.strftime("%Y-%m-%d %H:%M:%S"))
+    out = f"{_second_prefix[1]}.{now.microsecond:06d}"
     if "flush" not in kwargs:
         print(out, *args, flush=True, **kwargs)
     else:
@@ -42,6 +50,7 @@ def floats64_to_bytes(values):
 def uint64_to_signed_int(unsigned):
     """Converts 64-bit unsigned integer to signed integer. By Bit Twiddling Hacks; see
     https://stackoverflow.com/questions/1375897/how-to-get-the-signed-integer-value-of-a-long-in-python.
+    For scalars only; reinterpret arrays with `.view(np.int64)` instead, as `PLInterface.preprocess_raw_dma_data` does.
     """
-    unsigned &= (1 << 64) - 1  # Keep only the lowest 63 bits.
+    unsigned &= (1 << 64) - 1  # Keep only the lowest 64 bits.
     return (unsigned ^ 0x8000000000000000) - 0x8000000000000000  # Swap and shift down.
@@ -5,12 +5,16 @@ from sys import argv
 
 from helpers import printd
 
-if len(argv) == 1:
-    MOCK_PYNQ = False
-elif argv[1] == "-M":
-    MOCK_PYNQ = True
-else:
-    raise ValueError(f"Program argument {argv[1]} not understood. Options are:\n\t-M\tmock 'pynq' library")
+OPTIONS = {
+    "-M": "mock 'pynq' library",
+    "-I": "wait for DMA transfers on the interrupt of the DMA channel; only if the overlay connects it",
+}
+for arg in argv[1:]:
+    if arg not in OPTIONS:
+        options = "".join(f"\n\t{option}\t{description}" for option, description in OPTIONS.items())
+        raise ValueError(f"Program argument {arg} not understood. Options are:{options}")
+MOCK_PYNQ = "-M" in argv
+DMA_INTERRUPT = "-I" in argv
 
 if MOCK_PYNQ:  # mocking the pynq library
     printd("Mocking 'pynq' library...")
@@ -25,7 +29,7 @@ from tcp_server import TCPDataServer
 
 def main():
     printd("Started main server script.")
-    tds = TCPDataServer(host="", port=2024)
+    tds = TCPDataServer(host="", port=2024, dma_interrupt=DMA_INTERRUPT)
     tds.serve_one_client()
     printd("Stopped main server script.")
 
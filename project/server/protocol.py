@@ -1,5 +1,6 @@
 """Definitions for proper communication and programmable logic (PL) configuration parameters"""
 
+from fractions import Fraction
 from os.path import join
 
 from numpy import uint32
@@ -54,7 +55,14 @@ class TCPCommandProtocol:
     TCP_REQUEST_CMDS = {DATA, CPU_TEMP, QUEUE_SIZE}
     """All commands a client can use to request data from the TCP server"""
 
+    DATA_BULK = "D"
+    """Request up to the given number of IQ points (at most POINTS_PER_PACKET) in volts at once; response is prefixed
+    with the number of points (4 bytes, big endian) as it can be split over multiple TCP segments"""
+
     # MISC
+    COMMAND_END = "\n"
+    """Terminates every command, so that several commands can be sent in one go"""
+
     STOP_SERVER = "!"
     """Command to stop the TCP server remotely"""
 
@@ -124,7 +132,7 @@ class PLConfig:
         "mask": 0xFFFF0000
         },
         TCPCommandProtocol.IF_MULT: {
-        "scale": 256 / FCLK,
+        "scale": Fraction(256, FCLK),
         "mmio": MMIO_GENERAL,
         "mask": 0x0000FF00
         },
@@ -134,7 +142,9 @@ class PLConfig:
         "mask": 0x00000001
         },
     }
-    """Translation dictionary between TCP commands and fields in PL MMIOs. (scale, mmio, mask)"""
+    """Translation dictionary between TCP commands and fields in PL MMIOs. (scale, mmio, mask)
+    Scales are integers or fractions, so that scaling an integer value is exact.
+    """
 
     RAW_TO_VOLTS = 2 ** -25
     """Conversion of raw DMA output to volts"""
@@ -3,9 +3,9 @@
 import socket
 from queue import Empty
 from threading import Thread
-from time import sleep
 
 import helpers
+import numpy as np
 from data_processing import DataQueue, PLInterface
 from protocol import TCPCommandProtocol
 
@@ -19,8 +19,14 @@ class TCPDataServer(TCPCommandProtocol):
     class PLError(Exception):
         """Any kind of error relating to the Programmable Logic"""
 
-    BUFSIZE = 16
-    """Receiving buffer size"""
+    BUFSIZE = 4096
+    """Receiving buffer size, large enough to receive a whole batch of pipelined commands at once"""
+
+    SOCKET_OPTIONS = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+    """(level, option, value) set on every client connection. Nagle's algorithm is disabled so that responses to
+    pipelined commands are not held back until the client acknowledges the previous one.
+    Buffer sizes are left to the kernel's autotuning.
+    """
 
     QUEUE_TIMEOUT = 50E-3
     """How long to wait for additional data before deciding to send a halffull packet"""
@@ -28,38 +34,64 @@ class TCPDataServer(TCPCommandProtocol):
     DEBUG = True
     """Whether to print debugging information"""
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, dma_interrupt=False):
         self.host, self.port = host, port
         if TCPDataServer.DEBUG: helpers.printd(f"[TCP] Loading PL overlay {PLInterface.OVERLAY_PATH}...")
-        self.pl_interface = PLInterface()
+        self.pl_interface = PLInterface(dma_interrupt)
+
+        # Listen right away, so that clients can connect as soon as the server exists
+        try:
+            self.sock = socket.create_server((host, port), backlog=1)  # also sets SO_REUSEADDR
+        except OSError as err:
+            raise OSError(f"[TCP] Cannot start server on {host}:{port}: {err}") from err
+        if TCPDataServer.DEBUG: helpers.printd(f"[TCP] Started TCP data server on {host}:{port}.")
 
         # Create DataQueue object and start fetching thread
         self.queue = DataQueue()
+        self._data_packet = np.empty((TCPCommandProtocol.POINTS_PER_PACKET, 4))
+
+        # Responses to requests (no argument) by encoded command, and to commands (with argument) in a table indexed by
+        # their first byte, looked up by `determine_response`. Arguments are passed on as bytes, which int() parses directly
+        self._requests = {
+            TCPCommandProtocol.DATA.encode(): self.get_data,
+            TCPCommandProtocol.QUEUE_SIZE.encode(): self.get_queue_size,
+            TCPCommandProtocol.CPU_TEMP.encode(): self.get_cpu_temp,
+        }
+        # Anything change_config() can deal with, except for the commands that need more than a configuration change
+        self._commands = [None] * 256
+        for cmd in PLInterface.MMIO_FIELD_DICT:
+            self._commands[ord(cmd)] = lambda arg, cmd=cmd: self.change_config({cmd: int(arg)})
+        self._commands[ord(TCPCommandProtocol.DATA_BULK)] = lambda arg: self.get_data_bulk(int(arg))
+        self._commands[ord(TCPCommandProtocol.RUN_PL)] = lambda arg: self.control_on_off(arg.decode())
+
         helpers.printd("[TCP] Starting data fetch thread...")
         # Start the queue fetch method and point it to the PL interface get_data method
         self.fetch_thread = Thread(target=self.queue.keep_fetching, args=(self.pl_interface.get_data, ), name="vna_fetch_dma")
         self.fetch_thread.start()
 
-    def get_data(self):
+    def get_data(self, max_points=TCPCommandProtocol.POINTS_PER_PACKET):
         """Reads the I and Q data (points) from the data queue,
-        groups it into larger packets and converts to bytes.
+        groups it into larger packets of up to `max_points` (at most `POINTS_PER_PACKET`) points and returns them as a
+        bytes-like object.
+        This is a view on a buffer that is reused for the next packet, so it has to be sent before calling this again.
         """
         if not self.pl_interface.enable:
             return TCPCommandProtocol.RESPONSE_ERR
 
-        # List of float values to send
-        data_packet = []
+        # Array of points (rows of 4 voltages) to send, reused between packets
+        max_points = min(max_points, TCPCommandProtocol.POINTS_PER_PACKET)
+        data_packet = self._data_packet
+        points = 0
 
         # Assemble a response packet
-        while (len(data_packet) // 4) < TCPDataServer.POINTS_PER_PACKET:
-            # This gets data from the queue.
+        while points < max_points:
+            # This moves as many points as are available (and fit) from the queue into the packet
             try:
-                # Get a single point from the queue as a tuple of 4 voltages (Idut, Qdut, Iref, Qref)
-                point = self.queue.get(timeout=DataQueue.QUEUE_TIMEOUT)
+                points += self.queue.get_points(data_packet[points:], timeout=DataQueue.QUEUE_TIMEOUT)
             except Empty:
                 # Timeout occured: send immediately if we have anything
-                if len(data_packet) > 0:
-                    helpers.verbose(f"[TCP] No data in queue; sending {len(data_packet) // 4} point(s) now")
+                if points > 0:
+                    helpers.verbose(f"[TCP] No data in queue; sending {points} point(s) now")
                     break
                 else:  # Else, check if the fetching paused
                     if self.queue.paused.is_set():
@@ -68,11 +100,26 @@ class TCPDataServer(TCPCommandProtocol):
                     helpers.verbose("[TCP] No data in queue; waiting for more data")
                     continue
 
-            # Add point data to the packet
-            data_packet.extend(point)
+        # View the floats as bytes so they can be transmitted without copying them
+        return memoryview(data_packet[:points]).cast("B")
+
+    def get_data_bulk(self, max_points):
+        """Like `get_data`, but prefixes the packet with its number of points (4 bytes, big endian),
+        so that the client knows how much to receive.
+        """
+        data_packet = self.get_data(max_points)
+        if data_packet == TCPCommandProtocol.RESPONSE_ERR:
+            return data_packet
+        return b"".join(((len(data_packet) // 32).to_bytes(length=4, byteorder="big"), data_packet))
+
+    def get_queue_size(self):
+        """Returns the number of points in the data queue as bytes."""
+        # TODO: a bit weird 'innit
+        return self.queue.qsize().to_bytes(length=DataQueue.MAXSIZE_BITS // 8, byteorder="big")
 
-        # Convert floats to bytes so they can be transmitted
-        return helpers.floats64_to_bytes(data_packet)
+    def get_cpu_temp(self):
+        """Returns the SoC temperature as bytes."""
+        return helpers.floats64_to_bytes((helpers.cpu_temp(), ))
 
     def change_config(self, config: dict):
         """Changes fields in the hardware configuration of the PL according to the provided dictionary."""
@@ -132,49 +179,34 @@ class TCPDataServer(TCPCommandProtocol):
         self.pl_interface.enable = False  # Disable the PL (after transfer is done!!!)
 
     def determine_response(self, data):
-        """Logic for the server's response based on received decoded data"""
+        """Logic for the server's response based on a received command (bytes, without `COMMAND_END`)"""
         # Requests (no argument)
-        if data == TCPCommandProtocol.DATA:  # Data request
-            return self.get_data()
-        if data == TCPCommandProtocol.QUEUE_SIZE:  # Queue size request, TODO: a bit weird 'innit
-            return self.queue.qsize().to_bytes(length=DataQueue.MAXSIZE_BITS // 8, byteorder="big")
-        if data == TCPCommandProtocol.CPU_TEMP:  # SoC temperature request
-            return helpers.floats64_to_bytes((helpers.cpu_temp(), ))
-
-        if data[0] == TCPCommandProtocol.STOP_SERVER:  # Stop server
+        request = self._requests.get(data)
+        if request is not None:
+            return request()
+
+        if data[0] == ord(TCPCommandProtocol.STOP_SERVER):  # Stop server
             self.stop()
             return TCPCommandProtocol.RESPONSE_OK
 
         # Commands (with argument)
         if len(data) <= 1:  # We didn't get such argument >:(
-            helpers.printd(f"[TCP] Got command '{data[0]}' with no data!")
+            helpers.printd(f"[TCP] Got command '{data.decode(errors='replace')}' with no data!")
             return TCPCommandProtocol.RESPONSE_ERR
-        if data[0] == TCPCommandProtocol.RUN_PL:  # Acquisition enable/disable
-            return self.control_on_off(data[1:])
-        if data[0] in PLInterface.MMIO_FIELD_DICT:  # Anything change_config() can deal with
-            return self.change_config({data[0]: int(data[1:])})
+        command = self._commands[data[0]]
+        if command is not None:
+            return command(data[1:])
 
         # Unknown command
-        helpers.printd(f"[TCP] Got unknown command '{data}'!")
+        helpers.printd(f"[TCP] Got unknown command '{data.decode(errors='replace')}'!")
         return TCPCommandProtocol.RESPONSE_ERR
 
     def serve_one_client(self):
         """Sends acquired data to one client."""
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as self.sock:
-                try:
-                    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                    self.sock.bind((self.host, self.port))
-                    self.sock.listen(1)
-                except OSError as err:
-                    helpers.printd(f"Cannot start server: {str(err)}")
-                    return self.stop()  # raises server stop which gets caught by the top level try
-                if TCPDataServer.DEBUG:
-                    helpers.printd(f"Started TCP data server on {self.host}:{self.port}.")
-
+            with self.sock:
                 # Wait until client accepts connection.
                 while True:
-                    server_waits_for_client = True
                     try:
                         helpers.verbose("[TCP] waiting for client.")
                         conn, addr = self.sock.accept()  # blocking
@@ -185,52 +217,64 @@ class TCPDataServer(TCPCommandProtocol):
                         return self.stop()  # raises server stop which gets caught by the top level try
                     with conn:
                         if TCPDataServer.DEBUG: helpers.printd(f"{client} connected to the TCP server.")
+                        for option in TCPDataServer.SOCKET_OPTIONS:
+                            conn.setsockopt(*option)
 
                         # Loop until client disconnects.
-                        received_data = b""
+                        pending = b""  # Incomplete command, waiting for the rest to arrive
                         while True:
                             try:
-                                received_data = conn.recv(TCPDataServer.BUFSIZE)
+                                received_data = conn.recv(TCPDataServer.BUFSIZE)  # blocking
                             except (ConnectionResetError, BrokenPipeError) as err:
-                                if TCPDataServer.DEBUG:
-                                    helpers.printd(f"{client} caused exception: {err}")
-                                    continue
+                                if TCPDataServer.DEBUG: helpers.printd(f"{client} caused exception: {err}")
+                                break
                             if not received_data:
-                                if server_waits_for_client:
-                                    sleep(0)
-                                    continue
                                 if TCPDataServer.DEBUG: helpers.printd(f"{client} disconnected.")
                                 break
 
                             # Start processing commands when client sends them.
-                            server_waits_for_client = False
-                            try:
-                                response = self.determine_response(received_data.decode())
-                            except Exception as err:
-                                if isinstance(err, TCPDataServer.ServerStop):
-                                    return
-                                response = TCPCommandProtocol.RESPONSE_ERR
-                                if TCPDataServer.DEBUG:
-                                    helpers.printd(
-                                        f"Exception occured when processing command {received_data.decode()}: "
-                                        f"{type(err).__name__}: {' '.join([str(a) for a in err.args])}"
-                                    )
+                            *commands, pending = (pending + received_data).split(TCPDataServer.COMMAND_END.encode())
+                            responses = []  # Responses to this batch of commands, sent together
+                            for command in commands:
+                                if not command:
+                                    continue
+                                try:
+                                    response = self.determine_response(command)
+                                except Exception as err:
+                                    if isinstance(err, TCPDataServer.ServerStop):
+                                        self._respond(conn, client, responses)
+                                        return
+                                    response = TCPCommandProtocol.RESPONSE_ERR
+                                    if TCPDataServer.DEBUG:
+                                        helpers.printd(
+                                            f"Exception occured when processing command {command.decode(errors='replace')}: "
+                                            f"{type(err).__name__}: {' '.join([str(a) for a in err.args])}"
+                                        )
+                                responses.append(response)
+                                if isinstance(response, memoryview):
+                                    # Views on the data packet have to be sent before it is reused for the next command
+                                    self._respond(conn, client, responses)
 
                             # Respond to the client.
-                            try:
-                                conn.sendall(response)
-                            except (ConnectionResetError, BrokenPipeError):
-                                if TCPDataServer.DEBUG:
-                                    helpers.printd(f"{client} reset the connection.")
+                            self._respond(conn, client, responses)
 
                         self.pause_dma()  # Close currently running DMA transfer (if any)
         except TCPDataServer.ServerStop:
             return
 
+    def _respond(self, conn, client, responses):
+        """Sends a list of responses to the client in one go and clears the list."""
+        if not responses:
+            return
+        try:
+            conn.sendall(responses[0] if len(responses) == 1 else b"".join(responses))
+        except (ConnectionResetError, BrokenPipeError):
+            if TCPDataServer.DEBUG:
+                helpers.printd(f"{client} reset the connection.")
+        responses.clear()
+
     def stop(self):
         """Closes the TCP server, stops the threads that were started and raises the ServerStop exception."""
-        if not hasattr(self, "sock"):
-            return
         if TCPDataServer.DEBUG: helpers.printd("[TCP] Stopping TCP server...")
         self.sock.close()
         if TCPDataServer.DEBUG: helpers.printd("[TCP] Stopping data fetch thread...")
@@ -240,5 +284,6 @@ class TCPDataServer(TCPCommandProtocol):
         self.fetch_thread.join()  # Wait for DMA thread to exit
         if TCPDataServer.DEBUG: helpers.printd("[TCP] Stopping PL...")
         self.pl_interface.enable = False
+        self.pl_interface.close()
         if TCPDataServer.DEBUG: helpers.printd("[TCP] Goodbye!")
         raise TCPDataServer.ServerStop
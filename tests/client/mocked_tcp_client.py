@@ -12,6 +12,7 @@ class MockedTCPClient(TCPClient):
 
     def __init__(self, host: str, port: int) -> None:
         """Fakes to connect with a socket"""
+        self._rng = np.random.default_rng()
 
     def __exit__(self, *args) -> None:
         """Overloads parent class' __exit__ method."""
@@ -24,6 +25,24 @@ class MockedTCPClient(TCPClient):
             return (1).to_bytes(length=32, byteorder="big")
         return TCPCommandProtocol.RESPONSE_OK
 
-    def request_data(self) -> tuple[float] | tuple[float, float, float, float]:
+    def send_receive_into(self, command: bytes) -> memoryview:
+        """Mocks the communication of an encoded command the same way as `send_receive`."""
+        return memoryview(self.send_receive(command.decode("utf-8").removesuffix(TCPCommandProtocol.COMMAND_END)))
+
+    def request_data(self) -> np.ndarray:
+        """Returns test data: four randomised IQ values per point in interval [-1, 1)."""
+        return self._rng.uniform(-1, 1, 4 * TCPCommandProtocol.POINTS_PER_PACKET)
+
+    def request_data_bulk(self, points: int, out: np.ndarray | None = None) -> np.ndarray:
         """Returns test data: four randomised IQ values per point in interval [-1, 1)."""
-        return tuple((np.random.random_sample(4 * TCPCommandProtocol.POINTS_PER_PACKET) * 2 - 1))
+        if out is None:
+            out = np.empty((points, 4))
+        self._rng.random(out=out[:points])
+        return self._scale(out[:points])
+
+    @staticmethod
+    def _scale(values: np.ndarray) -> np.ndarray:
+        """Scales random values in [0, 1) to [-1, 1) in place."""
+        values *= 2
+        values -= 1
+        return values
@@ -1,11 +1,16 @@
 """Tests for Application Programming Interface"""
 
-from threading import Thread
+from copy import copy
+from contextlib import ExitStack
+from threading import Event, Thread
+from time import sleep
 from unittest.mock import patch
 
+import numpy as np
 from pytest import fail, raises
 
 from project.client.application.api import SLVNA
+from project.client.generator.base_controller import BaseSCPIGeneratorController
 from tests.client.mocked_generator import MockedGenController
 from tests.client.mocked_tcp_client import MockedTCPClient
 
@@ -26,8 +31,49 @@ def test_api_fsweep() -> None:
     # Patch the TCP client and obtain the mocked data.
     with patch("project.client.application.api.TCPClient", side_effect=MockedTCPClient):
         data = vna.run()[0]
+        first_result = data["DUT_re_V"].values.copy()
+        vna.run()  # reuses the receive buffer of the first sweep
 
     assert data.sizes.get("f") == 50, "should contain 50 frequencies (points)"
+    assert np.array_equal(data["DUT_re_V"], first_result), "second sweep should not change the results of the first"
+
+
+def test_expand_data() -> None:
+    """Compares the derived columns with the straightforward complex arithmetic they replace."""
+    points = 100
+    data = np.random.random_sample((points, 4)) * 2 - 1
+    f = np.linspace(1E9, 2E9, points)
+    t = np.arange(points, dtype=np.float64) * 1E-3
+    expanded = SLVNA._expand_data(t, f, data)
+
+    p_dut = data[:, 0] + 1j * data[:, 1]
+    p_ref = data[:, 2] + 1j * data[:, 3]
+    S_21 = (p_dut / p_ref) ** 2
+    ph_unwrapped = np.unwrap(np.angle(S_21))
+    avg_slope = (ph_unwrapped[-1] - ph_unwrapped[0]) / (f[-1] - f[0])
+    expected = {
+        "DUT_re_V": data[:, 0],
+        "DUT_im_V": data[:, 1],
+        "DUT_mag_V": np.abs(p_dut),
+        "DUT_mag_dBm": 20 * np.log10(np.abs(p_dut)) + 10,
+        "DUT_phase": np.angle(p_dut),
+        "REF_re_V": data[:, 2],
+        "REF_im_V": data[:, 3],
+        "REF_mag_V": np.abs(p_ref),
+        "REF_mag_dBm": 20 * np.log10(np.abs(p_ref)) + 10,
+        "REF_phase": np.angle(p_ref),
+        "S_21": S_21,
+        "S_21_re": np.real(S_21),
+        "S_21_im": np.imag(S_21),
+        "S_21_mag": np.abs(S_21),
+        "S_21_mag_dB": 10 * np.log10(np.abs(S_21)),
+        "S_21_phase_unwrapped": ph_unwrapped - (f - f[0]) * avg_slope,
+    }
+    for key, value in expected.items():
+        assert np.allclose(expanded[key], value), f"{key} differs from reference calculation"
+    # Phases are only equal modulo 2 pi (angle of -1 can be either pi or -pi)
+    phase_diff = np.angle(np.exp(1j * (expanded["S_21_phase"].values - np.angle(S_21))))
+    assert np.allclose(phase_diff, 0), "S_21_phase differs from reference calculation"
 
 
 def test_kwargs() -> None:
@@ -46,18 +92,94 @@ def test_kwargs() -> None:
         fail("Should not be able to change _deadtime attribute since starts with `_`.")
 
 
+def test_ping_cache() -> None:
+    """Tests that readiness checks reuse recent generator pings unless forced to ping again."""
+    vna = new_imaginary_vna()
+    vna.set_fsweep(1E6, 5E6, -1, points=20, timestep=3)
+    with patch.object(MockedGenController, "network_ping_rtt", return_value=("1.2.3.4", 1E-12)) as ping:
+        vna._ready_checks()
+        assert ping.call_count == 3, "each of the three generators should have been pinged once"
+        vna._ready_checks()
+        assert ping.call_count == 3, "recent pings should have been reused"
+        vna._ready_checks(force_ping=True)
+        assert ping.call_count == 6, "force_ping should ping every generator again"
+
+
+def test_config_caches() -> None:
+    """Tests that runtime caches do not take part in comparing or representing a VNA."""
+    vna = new_imaginary_vna()
+    vna._receive_buffer(10)
+    other = copy(vna)
+    other._rx_buffer = None
+    other._receive_buffer(20)
+    assert vna == other, "VNAs that only differ in their receive buffers should be equal"
+    assert "_rx_buffer" not in repr(vna) and "_ping_cache" not in repr(vna), "caches should not be represented"
+
+
+def test_sweep_capabilities() -> None:
+    """Tests that readiness checks require the generator operation belonging to the sweep mode."""
+    vna = new_imaginary_vna()
+    capabilities = MockedGenController.capabilities()
+    capabilities["operations"][BaseSCPIGeneratorController.psweep] = False
+    with patch.object(MockedGenController, "capabilities", return_value=capabilities):
+        vna.set_fsweep(1E6, 5E6, -1, points=20, timestep=3)
+        vna._ready_checks()
+        vna.set_psweep(1E6, -10, 0, points=20, timestep=3)
+        with raises(NotImplementedError):
+            vna._ready_checks()
+            fail("Generators that cannot do a power sweep should be rejected for a power sweep.")
+
+
+def test_connect_failure_closes_tcp() -> None:
+    """Tests that the TCP client is closed right away when it connected but a generator did not."""
+    vna = new_imaginary_vna()
+    exits = []
+
+    class RecordingTCPClient(MockedTCPClient):
+        """Mocked TCP client that records when it is closed"""
+
+        def __exit__(self, *args) -> None:
+            exits.append(args[0])
+
+    with patch("project.client.application.api.TCPClient", side_effect=RecordingTCPClient), \
+            patch.object(vna.gen_lo, "__enter__", side_effect=ConnectionError("LO unreachable")):
+        stack = ExitStack()
+        with raises(ConnectionError):
+            vna._connect_concurrently(stack, vna.gen_rf, vna.gen_lo, vna.gen_clk)
+            fail("Failing to connect to a generator should raise its error.")
+        assert exits == [ConnectionError], "TCP client should be closed before the error is raised"
+        stack.close()
+    assert exits == [ConnectionError], "TCP client should not be closed again by the stack"
+
+
 def test_running() -> None:
     """Tests that simultaneous measurements are rejected."""
     vna = new_imaginary_vna()
 
+    # Keep the background measurement busy until the second measurement has been attempted.
+    release = Event()
+
+    class BlockingTCPClient(MockedTCPClient):
+        """Mocked TCP client that blocks when starting acquisition until released"""
+
+        def start_acquisition(self) -> None:
+            release.wait(timeout=5)
+
     # Set up a one-minute sweep in the background.
     vna.set_fsweep(1E6, 5E6, -1, points=20, timestep=3)
-    with patch("project.client.application.api.TCPClient", side_effect=MockedTCPClient):
+    with patch("project.client.application.api.TCPClient", side_effect=BlockingTCPClient):
         run_background = Thread(target=vna.run, name="vna_run")
         run_background.start()
+        for _ in range(500):
+            if vna.running:
+                break
+            sleep(0.01)
 
         # Try a new measurement.
-        with raises(ValueError):
-            vna.run()
-            fail("Should not be able to start new measurement by raising ValueError!")
-        run_background.join()
+        try:
+            with raises(ValueError):
+                vna.run()
+                fail("Should not be able to start new measurement by raising ValueError!")
+        finally:
+            release.set()
+            run_background.join()
@@ -1,3 +1,5 @@
+from unittest.mock import Mock
+
 import pytest
 import pyvisa
 
@@ -40,3 +42,27 @@ def test_anapico_without_connect() -> None:
     with pytest.raises(pyvisa.errors.Error):
         APUASYN20Controller(invalid_addr, ref_out_enabled=True)
         pytest.fail(f"Should have raised pyvisa error since cannot connect to {invalid_addr}.")
+
+
+def test_anapico_fsweep_commands() -> None:
+    """Tests that a frequency sweep is configured in a single write and its dwell time excludes the deadtime."""
+    pico = APUASYN20Controller("INSTR::^4*[@8m\n,b;3_!")
+    pico.gen = Mock()
+    pico.fsweep(2E9, 1E9, 10, 101, 1E-3)
+    pico.gen.write.assert_called_once_with(
+        "SWE:DIR DOWN;:POW:AMPL 10DBM;:FREQ:STAR 1000000000.0Hz;:FREQ:STOP 2000000000.0Hz;:SWE:POIN 101;:SWE:DWEL 0.0005s"
+    )
+    with pytest.raises(ValueError):
+        pico.fsweep(1E9, 2E9, 10, 101, 100E-6)
+        pytest.fail("Should have rejected a timestep shorter than the deadtime.")
+
+
+def test_anapico_query() -> None:
+    """Tests that raw query responses are parsed as numbers or stripped strings."""
+    pico = APUASYN20Controller("INSTR::^4*[@8m\n,b;3_!")
+    pico.gen, pico._write_end = Mock(), b"\r\n"
+    pico.gen.read_raw.return_value = b"1\n"
+    assert pico.is_locked(), "numeric response should be parsed as a float"
+    pico.gen.write_raw.assert_called_once_with(b"ROSC:LOCK?\r\n")
+    pico.gen.read_raw.return_value = b"AnaPico AG,APUASYN20\n"
+    assert pico.query("*IDN?") == "AnaPico AG,APUASYN20", "text response should be decoded without termination"
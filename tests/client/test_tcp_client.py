@@ -1,6 +1,10 @@
 """Tests for the TCP client"""
 
-from time import perf_counter_ns
+import socket
+from contextlib import contextmanager
+from threading import Thread
+from time import perf_counter_ns, sleep
+from typing import Callable, Iterator
 
 import numpy as np
 import pytest
@@ -15,6 +19,129 @@ PORT = TCPCommandProtocol.TCP_PORT
 """Use default port from protocol."""
 
 
+@pytest.fixture
+def client_peer() -> Iterator[tuple[TCPClient, socket.socket]]:
+    """Client that skipped connecting to a server, and the socket at the other end of its connection.
+    Both are closed after the test.
+    """
+    client = TCPClient.__new__(TCPClient)
+    client._rx_view = memoryview(bytearray(TCPClient.BUFSIZE))
+    client.socket, peer = socket.socketpair()
+    yield client, peer
+    client.socket.close()
+    peer.close()
+
+
+@contextmanager
+def responding(respond: Callable[[], None]) -> Iterator[None]:
+    """Runs `respond` in a thread during the `with` block, and raises its exception (e.g. a failed assert) afterwards."""
+    errors = []
+
+    def run() -> None:
+        try:
+            respond()
+        except Exception as err:
+            errors.append(err)
+
+    thr = Thread(target=run)
+    thr.start()
+    try:
+        yield
+    finally:
+        thr.join(timeout=5)
+    if errors:
+        raise errors[0]
+
+
+def test_request_data_bulk_split_packet(client_peer: tuple[TCPClient, socket.socket]) -> None:
+    """Tests that a data packet split over multiple TCP segments is reassembled into whole points."""
+    client, server = client_peer
+    expected = np.arange(8, dtype=np.float64).reshape(2, 4)
+
+    def respond() -> None:
+        assert server.recv(16) == (TCPCommandProtocol.DATA_BULK + "2" + TCPCommandProtocol.COMMAND_END).encode(), \
+            "client should request two points"
+        response = (2).to_bytes(length=4, byteorder="big") + expected.tobytes()
+        server.sendall(response[:2])  # split inside the point count
+        sleep(0.1)
+        server.sendall(response[2:24])  # and inside a point
+        sleep(0.1)
+        server.sendall(response[24:])
+
+    with responding(respond):
+        out = client.request_data_bulk(2)
+    assert np.array_equal(out, expected), "received points are not equal to the sent points"
+
+
+def test_request_data_bulk_chunks(client_peer: tuple[TCPClient, socket.socket]) -> None:
+    """Tests that a long bulk request is split into requests of at most one packet, so the server answers in time."""
+    client, server = client_peer
+    points = 2 * TCPCommandProtocol.POINTS_PER_PACKET + 1
+    expected = np.arange(4 * points, dtype=np.float64).reshape(points, 4)
+    requested = []
+
+    def respond() -> None:
+        received, sent = b"", 0
+        while sent < points:
+            while TCPClient.COMMAND_END not in received:
+                received += server.recv(64)
+            command, received = received.split(TCPClient.COMMAND_END, 1)
+            count = min(int(command[1:]), points - sent)
+            requested.append(int(command[1:]))
+            server.sendall(count.to_bytes(length=4, byteorder="big") + expected[sent:sent + count].tobytes())
+            sent += count
+
+    with responding(respond):
+        out = client.request_data_bulk(points)
+    assert max(requested) <= TCPCommandProtocol.POINTS_PER_PACKET, "bulk requests should be at most one packet long"
+    assert np.array_equal(out, expected), "received points are not equal to the sent points"
+
+
+def test_config_commands_microseconds(client_peer: tuple[TCPClient, socket.socket]) -> None:
+    """Tests that times are sent as whole microseconds, rounded the same way as formatting with '.0f'."""
+    client, server = client_peer
+    times = (1E-3, 2.5E-6, 3.5E-6, 0.1234567)
+    server.sendall(TCPCommandProtocol.RESPONSE_OK * len(times))
+    with client.batch() as responses:
+        for time in times:
+            client.send_tpp(time)
+    expected = b"".join(f"{TCPCommandProtocol.TPP}{time*1E6:.0f}\n".encode() for time in times)
+    assert server.recv(len(expected)) == expected, "times per point should be sent as rounded integer microseconds"
+    assert responses == [TCPCommandProtocol.RESPONSE_OK] * len(times), "every command should get its response"
+
+
+def test_batch_larger_than_buffer(client_peer: tuple[TCPClient, socket.socket]) -> None:
+    """Tests that a batch with more responses than fit in the receive buffer gets all of them, in order."""
+    client, server = client_peer
+    count = 2 * TCPClient.BUFSIZE + 1
+    expected = [TCPCommandProtocol.RESPONSE_OK if i % 3 else TCPCommandProtocol.RESPONSE_ERR for i in range(count)]
+
+    def respond() -> None:
+        received = b""
+        while received.count(TCPClient.COMMAND_END) < count:
+            received += server.recv(65536)
+        server.sendall(b"".join(expected))
+
+    with responding(respond), client.batch() as responses:
+        for _ in range(count):
+            client.send_dead_time(1)
+    assert responses == expected, "every command should get its own response, in order"
+
+
+def test_ping(client_peer: tuple[TCPClient, socket.socket]) -> None:
+    """Tests that the ping is measured with requests over the existing connection."""
+    client, server = client_peer
+
+    def respond() -> None:
+        for _ in range(3):
+            assert server.recv(16) == TCPClient.REQUEST_QUEUE_SIZE, "client should request the queue size"
+            server.sendall((0).to_bytes(length=4, byteorder="big"))
+
+    with responding(respond):
+        rtt = client.ping(count=3)
+    assert 0 < rtt < 1, "round trip time over a local socket should be positive and well below a second"
+
+
 @pytest.mark.skip()
 def test_performance_tcp_client() -> None:
     # Always use the `with` block to ensure proper connection closing. This is a test for vna v1_7_0.
@@ -84,6 +84,11 @@ class Overlay:
                 if not Overlay.PL_ENABLED:
                     raise RuntimeError("[TEST] MockedPynq: PL still in reset, DMA will hang!")
 
+            @staticmethod
+            async def wait_async() -> None:
+                """Same as `wait`, for an overlay that connects the interrupt of the channel."""
+                Overlay.dma.recvchannel.wait()
+
             @staticmethod
             def stop() -> None:
                 """Stops the current DMA transfer"""
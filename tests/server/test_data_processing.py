@@ -1,10 +1,13 @@
 """Tests data processing classes and functions, also on systems that do not have `pynq` installed"""
 
+from queue import Empty
 from threading import Thread
 
+import numpy as np
 from numpy import ndarray
 from pytest import fail, raises
 
+from project.server import helpers
 from tests.server import mocked_pynq
 
 # Apply the mocked pynq module before importing the classes to be tested.
@@ -38,6 +41,70 @@ def test_dma_get_data() -> None:
     assert isinstance(data[0], float), "preprocess_raw_dma_data should return floatlikes"
 
 
+def test_dma_wait_interrupt() -> None:
+    # Transfers should wait on the interrupt of the DMA channel only if the overlay connects it, else poll its status.
+    class RecordingChannel:
+        """DMA receive channel that records how transfers were waited for"""
+
+        def __init__(self) -> None:
+            self.waits = []
+
+        def transfer(self, buffer: ndarray) -> None:
+            buffer[:] = 1  # valid sample counts
+
+        def wait(self) -> None:
+            self.waits.append("poll")
+
+        async def wait_async(self) -> None:
+            self.waits.append("interrupt")
+
+    for dma_interrupt, expected in ((False, "poll"), (True, "interrupt")):
+        pl_i = PLInterface(dma_interrupt=dma_interrupt)
+        pl_i.dma_channel = RecordingChannel()
+        pl_i.enable = True
+        pl_i.get_data()
+        pl_i.get_data()
+        assert pl_i.dma_channel.waits == [expected] * 2, f"DMA transfers should {expected} with dma_interrupt={dma_interrupt}"
+        assert pl_i.dma_status == 2, "DMA status should be 2 again after transfer finished"
+        loop = pl_i._dma_loop
+        pl_i.close()
+        assert loop is None or loop.is_closed(), "closing the interface should close its event loop"
+
+
+def test_preprocess_raw_dma_data() -> None:
+    # Convert packets of (low word, high word, count) with positive and negative values to volts.
+    values = [0, 1, -1, 2 ** 40 + 12345, -(2 ** 40) - 12345, 2 ** 63 - 1, -(2 ** 63)]
+    counts = [1, 3, 7, 100, 12345, 2 ** 32 - 1, 1]
+    buffer = np.empty(3 * len(values), dtype=PLInterface.DMA_DTYPE)
+    for i, (value, count) in enumerate(zip(values, counts)):
+        unsigned = value % 2 ** 64
+        buffer[3 * i:3 * i + 3] = unsigned & 0xFFFFFFFF, unsigned >> 32, count
+    volts = PLInterface.preprocess_raw_dma_data(buffer)
+    expected = [
+        helpers.uint64_to_signed_int((int(buffer[j + 1]) << 32) + int(buffer[j])) / buffer[j + 2] * PLInterface.RAW_TO_VOLTS
+        for j in range(0, len(buffer), 3)
+    ]
+    assert volts.dtype == np.float64, "preprocess_raw_dma_data should return 64-bit floats"
+    assert np.array_equal(volts, expected), "vectorised conversion differs from conversion per point"
+    out = np.empty(len(values))
+    assert PLInterface.preprocess_raw_dma_data(buffer, out=out) is out, "conversion should write into the given output"
+    assert np.array_equal(out, expected), "conversion into the given output differs from conversion per point"
+
+
+def test_points_per_transfer() -> None:
+    # Shrinking the transfer size should reuse the DMA allocation, growing it should reallocate.
+    pl_i = PLInterface()
+    pl_i.points_per_transfer = 5
+    pool = pl_i._dma_pool
+    pl_i.points_per_transfer = 2
+    assert pl_i.points_per_transfer == 2, "points per transfer not updated"
+    assert len(pl_i.dma_output_buffer) == 2 * PLInterface.DMA_PACKET_LENGTH + 4, "DMA buffer has the wrong length"
+    assert pl_i._dma_pool is pool, "smaller transfers should reuse the DMA allocation"
+    pl_i.points_per_transfer = 10
+    assert pl_i.points_per_transfer == 10, "points per transfer not updated"
+    assert len(pl_i._dma_pool) >= 10 * PLInterface.DMA_PACKET_LENGTH + 4, "DMA allocation should have grown"
+
+
 def test_mmio() -> None:
     # Test writing and reading memory-mapped input/output registers.
     pl_i = PLInterface()
@@ -63,7 +130,9 @@ def test_queue() -> None:
     thr = Thread(target=dq.keep_fetching, args=(test_data_func, ))
     thr.start()
     dq.fetch.set()
-    assert dq.get(timeout=5) == test_data_func(), "queue is not filled with test data"
+    out = np.empty((2, 4))
+    assert dq.get_points(out, timeout=5) > 0, "queue is not filled with test data"
+    assert (out[0] == test_data_func()).all(), "queue does not return the test data"
 
     # Send signal to thread and wait for response pause signal.
     dq.fetch.clear()
@@ -73,3 +142,20 @@ def test_queue() -> None:
     dq.exit.set()
     thr.join(timeout=5)
     assert not thr.is_alive(), "thread should exit after setting attribute `is_waiting` to False"
+
+
+def test_queue_put_get_points() -> None:
+    # Fill a small queue with more points than fit in a single call.
+    DataQueue.MAXSIZE_BITS = 3
+    dq = DataQueue()
+    points = np.arange(40.).reshape(-1, 4)
+    assert dq.put_points(points[:5]) == 5 and dq.qsize() == 5, "points not stored in the queue"
+    out = np.empty((4, 4))
+    assert dq.get_points(out) == 4 and (out == points[:4]).all(), "oldest points not returned first"
+    assert dq.put_points(points[5:]) == 5, "queue should only store the points that fit"
+
+    # Read back across the end of the ring, then check that an empty queue times out.
+    out = np.empty((10, 4))
+    assert dq.get_points(out) == 6 and (out[:6] == points[4:]).all(), "points wrapping around the ring were corrupted"
+    with raises(Empty):
+        dq.get_points(out, timeout=0)
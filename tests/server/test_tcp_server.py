@@ -4,6 +4,8 @@ from threading import Thread
 from types import TracebackType
 from typing import Type
 
+import numpy as np
+
 # Apply the mocked pynq module before importing the classes to be tested.
 from project.server.protocol import TCPCommandProtocol
 from tests.server import mocked_pynq
@@ -32,12 +34,12 @@ def test_tcp_commands() -> None:
     dead_time = 100E-6  # seconds
     tpp = 1E-3  # seconds
     trig_length = 10E-6  # seconds
-    tds = TCPDataServer(host="localhost", port=2024)
+    tds = TCPDataServer(host="localhost", port=0)  # Any free port
     thr = Thread(target=tds.serve_one_client, name="test_tcp_data_server")
 
     # Start local test server and connect with client.
     thr.start()
-    with TCPClient(host="localhost", port=2024) as tc:
+    with TCPClient(host="localhost", port=tds.sock.getsockname()[1]) as tc:
         # Send config parameters.
         tc.send_dead_time(dead_time)
         tc.send_tpp(tpp)
@@ -74,14 +76,17 @@ def test_tcp_commands() -> None:
 
 
 def test_tcp_request_data() -> None:
-    tds = TCPDataServer(host="localhost", port=2025)
+    tds = TCPDataServer(host="localhost", port=0)  # Any free port
     thr = Thread(target=tds.serve_one_client, name="server_thread")
 
     # Start local test server and connect with client.
     thr.start()
-    with TCPClient(host="localhost", port=2025) as tc:
-        tc.send_tpp(2)  # minimal settings for no error
-        tc.send_dead_time(1)  # 0 < dead_time < tpp
+    with TCPClient(host="localhost", port=tds.sock.getsockname()[1]) as tc:
+        with tc.batch() as responses:
+            tc.send_tpp(2)  # minimal settings for no error
+            tc.send_dead_time(1)  # 0 < dead_time < tpp
+        assert responses == [TCPCommandProtocol.RESPONSE_OK] * 2, "batched configuration commands should all succeed"
+        assert tds.pl_interface.read_mmio(tds.TPP) == 2E6, "batched time per point not written to MMIO register"
         assert (  # try data request
             tc.send_receive(TCPCommandProtocol.DATA) == TCPCommandProtocol.RESPONSE_ERR
         ), "acquisition not started should return error response"
@@ -89,9 +94,11 @@ def test_tcp_request_data() -> None:
         # Start acquisition and request data again.
         tc.start_acquisition()
         data = tc.request_data()
+        bulk = tc.request_data_bulk(3)
     # Stop server when exiting with block
     assert len(data) > 0, "data should not be empty"
     assert len(data) <= TCPCommandProtocol.POINTS_PER_PACKET * 4, "data should not be longer than 4 * points per packetwt"
     assert isinstance(data[0], float), "data element should be float"
+    assert bulk.shape == (3, 4), "request_data_bulk should return exactly the requested points"
     thr.join(timeout=15)
     assert not thr.is_alive(), "server did not exit properly"